@@ -1,12 +1,14 @@
 import streamlit as st
-import requests
-from main import build_suggestions_json
+import resources
+import db
+import metrics
+import thumbnails
 from urllib.parse import urlencode, urlunparse
 from datetime import datetime
 import psycopg2
 import json
-import random
 import os
+import zlib
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -16,6 +18,16 @@ load_dotenv()
 NEON_DB_URL = os.getenv("NEON_DB_URL")
 COCKROACH_DB_URL = os.getenv("COCKROACH_DB_URL")
 
+@st.cache_resource
+def start_resource_warm_up():
+    # Runs once per server process, so the first chat message doesn't pay for model loading.
+    # Called after the sidebar is drawn: login redirects and the first paint never wait on it
+    metrics.start_http_server()
+    if os.getenv("WORKER_URL"):
+        # The worker service holds the model and index, this process never uses them
+        return None
+    return resources.warm_up_in_background()
+
 def connect_db(db_type):
     try:
         if db_type == "local":
@@ -33,31 +45,240 @@ def connect_db(db_type):
         print(f"Error connecting to {db_type} database: {e}")
         return None
 
-def update_sessions_to_db(chat_sessions, userid):
-    with connect_db("local") as conn:
+@st.cache_resource
+def create_tables():
+    with db.connection("create_tables") as conn:
         cursor = conn.cursor()
+        # One row per message, so a rerun only writes the messages it added
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                user_id BIGINT NOT NULL,
+                chat_name TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT,
+                image_urls JSONB NOT NULL DEFAULT '[]',
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (user_id, chat_name, position)
+            )
+        """)
+        # One row per wishlisted product, so adding or removing one is a single idempotent statement
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS wishlist_items (
+                user_id BIGINT NOT NULL,
+                product_uri TEXT NOT NULL,
+                added_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (user_id, product_uri)
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS wishlist_items_user_added ON wishlist_items (user_id, added_at DESC)"
+        )
+        # One row per chat, kept up to date as messages are saved, so the sidebar never reads chat_messages
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_index (
+                user_id BIGINT NOT NULL,
+                chat_name TEXT NOT NULL,
+                title TEXT,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (user_id, chat_name)
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_index_user_updated ON chat_index (user_id, updated_at DESC)"
+        )
+        conn.commit()
+    return True
 
-        session_data_json = json.dumps(dict(chat_sessions))
+def append_messages_to_db(userid, chat_name, start_position, messages):
+    # The chat's index row is updated in the same transaction: the first user message
+    # becomes its title, and the count and time move forward
+    title = next((message["content"] for message in messages if message["role"] == "user"), None)
+    with db.connection("append_messages") as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """INSERT INTO chat_messages (user_id, chat_name, position, role, content, image_urls)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON CONFLICT (user_id, chat_name, position) DO NOTHING""",
+            [
+                (userid, chat_name, start_position + offset, message["role"], message["content"],
+                 json.dumps(message.get("image_urls", [])))
+                for offset, message in enumerate(messages)
+            ]
+        )
+        cursor.execute(
+            """INSERT INTO chat_index (user_id, chat_name, title, message_count)
+               VALUES (%s, %s, %s, %s)
+               ON CONFLICT (user_id, chat_name) DO UPDATE SET
+                   title = COALESCE(chat_index.title, EXCLUDED.title),
+                   message_count = GREATEST(chat_index.message_count, EXCLUDED.message_count),
+                   updated_at = now()""",
+            (userid, chat_name, title[:200] if title else None, start_position + len(messages))
+        )
+        conn.commit()
 
+def backfill_chat_index(userid):
+    # Index the chats saved before chat_index existed, once
+    with db.connection("backfill_chat_index") as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """INSERT INTO chat_index (user_id, chat_name, title, message_count, created_at, updated_at)
+               SELECT user_id, chat_name,
+                      left((array_agg(content ORDER BY position) FILTER (WHERE role = 'user'))[1], 200),
+                      count(*), min(created_at), max(created_at)
+               FROM chat_messages WHERE user_id = %s
+               GROUP BY user_id, chat_name
+               ON CONFLICT (user_id, chat_name) DO NOTHING""",
+            (userid,)
+        )
+        conn.commit()
+
+def fetch_chat_count_from_db(userid):
+    with db.connection("fetch_chat_count") as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM chat_index WHERE user_id = %s", (userid,))
+        return cursor.fetchone()[0]
+
+def fetch_chat_index_page_from_db(userid, search, limit, offset):
+    """One page of the user's chats, most recently updated first, and how many match search."""
+    # search matches anywhere in the title, taken literally
+    pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    with db.connection("fetch_chat_index_page") as conn:
+        cursor = conn.cursor()
+        where = "user_id = %s AND title ILIKE %s" if search else "user_id = %s"
+        cursor.execute(
+            f"""SELECT chat_name, title, message_count, updated_at, count(*) OVER () FROM chat_index
+                WHERE {where} ORDER BY updated_at DESC, chat_name
+                LIMIT %s OFFSET %s""",
+            ((userid, pattern) if search else (userid,)) + (limit, offset)
+        )
+        rows = cursor.fetchall()
+        chats = [
+            {"chat_name": chat_name, "title": title, "message_count": message_count, "updated_at": updated_at}
+            for chat_name, title, message_count, updated_at, _ in rows
+        ]
+        return chats, (rows[0][4] if rows else 0)
+
+def fetch_chat_messages_from_db(userid, chat_name):
+    with db.connection("fetch_chat_messages") as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT role, content, image_urls FROM chat_messages
+               WHERE user_id = %s AND chat_name = %s ORDER BY position""",
+            (userid, chat_name)
+        )
+        messages = []
+        for role, content, image_urls in cursor.fetchall():
+            message = {"role": role, "content": content}
+            if role == "assistant":
+                message["image_urls"] = image_urls
+            messages.append(message)
+        return messages
+
+def migrate_sessions_to_messages(userid):
+    # Move chats saved as one JSON blob in user_sessions into chat_messages, once
+    legacy_sessions = fetch_sessions_from_db(userid)
+    if not legacy_sessions:
+        return
+    for chat_name, messages in legacy_sessions.items():
+        append_messages_to_db(userid, chat_name, 0, messages)
+    with db.connection("clear_legacy_sessions") as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE user_sessions SET chat_sessions = '{}' WHERE user_id = %s", (userid,))
+        conn.commit()
+
+def save_new_messages(userid):
+    """Write only the messages added since the last save, for every chat opened in this session."""
+    for chat_name, messages in st.session_state.chat_sessions.items():
+        saved_count = st.session_state.saved_message_counts.get(chat_name, 0)
+        if len(messages) <= saved_count:
+            continue
+        append_messages_to_db(userid, chat_name, saved_count, messages[saved_count:])
+        st.session_state.saved_message_counts[chat_name] = len(messages)
+        if not saved_count:
+            # First save of a chat started in this session
+            st.session_state.chat_count += 1
+        # The chat moved to the top of the list, and may have a title now
+        st.session_state.chat_index_pages = {}
+
+def get_chat_index_page(userid, search, page, page_size):
+    # Pages are cached for the session and only re-queried after this session saves messages
+    pages = st.session_state.setdefault("chat_index_pages", {})
+    if (search, page) not in pages:
+        pages[(search, page)] = fetch_chat_index_page_from_db(userid, search, page_size, page * page_size)
+    return pages[(search, page)]
+
+def add_to_wishlist_db(userid, product_uri):
+    with db.connection("add_to_wishlist") as conn:
+        cursor = conn.cursor()
         cursor.execute(
-            "UPDATE user_sessions SET chat_sessions = %s WHERE user_id = %s",
-            (session_data_json, userid)
+            "INSERT INTO wishlist_items (user_id, product_uri) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (userid, product_uri)
         )
         conn.commit()
 
-def update_wishlist_to_db(wishlist_products, userid):
-    with connect_db("local") as conn:
+def remove_from_wishlist_db(userid, product_uri):
+    with db.connection("remove_from_wishlist") as conn:
         cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM wishlist_items WHERE user_id = %s AND product_uri = %s",
+            (userid, product_uri)
+        )
+        conn.commit()
 
-        session_data_json = json.dumps(wishlist_products)
+def fetch_wishlist_page_from_db(userid, limit, offset):
+    """One page of the wishlist, newest first, and the total number of items."""
+    with db.connection("fetch_wishlist_page") as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT product_uri, count(*) OVER () FROM wishlist_items
+               WHERE user_id = %s ORDER BY added_at DESC, product_uri
+               LIMIT %s OFFSET %s""",
+            (userid, limit, offset)
+        )
+        rows = cursor.fetchall()
+        if not rows and offset:
+            cursor.execute("SELECT count(*) FROM wishlist_items WHERE user_id = %s", (userid,))
+            return [], cursor.fetchone()[0]
+        return [row[0] for row in rows], (rows[0][1] if rows else 0)
+
+def migrate_wishlist_to_items(userid):
+    # Move products saved in the legacy wishlist JSON document into wishlist_items, once
+    legacy_products = fetch_wishlist_from_db(userid).get("products") or []
+    if not legacy_products:
+        return
+    with db.connection("migrate_wishlist") as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO wishlist_items (user_id, product_uri) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            [(userid, product_uri) for product_uri in dict.fromkeys(legacy_products)]
+        )
         cursor.execute(
             "UPDATE wishlist SET products = %s WHERE user_id = %s",
-            (session_data_json, userid)
+            (json.dumps({"products": []}), userid)
         )
         conn.commit()
 
+def add_to_wishlist(userid, product_uri):
+    add_to_wishlist_db(userid, product_uri)
+    # Cached pages are stale now
+    st.session_state.wishlist_pages = {}
+
+def remove_from_wishlist(userid, product_uri):
+    remove_from_wishlist_db(userid, product_uri)
+    st.session_state.wishlist_pages = {}
+
+def get_wishlist_page(userid, page, page_size):
+    # Pages are cached for the session and only re-queried after this session changes the wishlist
+    pages = st.session_state.setdefault("wishlist_pages", {})
+    if page not in pages:
+        pages[page] = fetch_wishlist_page_from_db(userid, page_size, page * page_size)
+    return pages[page]
+
 def fetch_sessions_from_db(userid):
-    with connect_db("local") as conn:
+    with db.connection("fetch_sessions") as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT chat_sessions FROM user_sessions WHERE user_id = %s",
@@ -70,7 +291,7 @@ def fetch_sessions_from_db(userid):
         return None
     
 def fetch_wishlist_from_db(userid):
-    with connect_db("local") as conn:
+    with db.connection("fetch_wishlist") as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT products FROM wishlist WHERE user_id = %s",
@@ -85,7 +306,7 @@ def fetch_wishlist_from_db(userid):
     
 
 def check_user_in_db(userid):
-    with connect_db("local") as conn:
+    with db.connection("check_user") as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT EXISTS(SELECT 1 FROM user_sessions WHERE user_id = %s)",
@@ -98,7 +319,7 @@ def check_user_in_db(userid):
 
 def add_user_to_db(userid):
     print("hi")
-    with connect_db("local") as conn:
+    with db.connection("add_user") as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO user_sessions (user_id, chat_sessions) VALUES (%s, '{}')",
@@ -107,13 +328,6 @@ def add_user_to_db(userid):
         conn.commit()
         print("done")
 
-        wishlist = {"products":[]}
-        cursor.execute(
-            "INSERT INTO wishlist (user_id, products) VALUES (%s, %s)",
-            (userid, json.dumps(wishlist))
-        )
-        conn.commit()
-
 
 def check_login_status():
     try:
@@ -137,7 +351,7 @@ def redirect_to_login():
 def chatbot():
     if not check_login_status():
         redirect_to_login()
-        
+        return
 
     userid = int(st.query_params.get("user_id"))
     
@@ -160,8 +374,19 @@ def chatbot():
 
     username = "User"
     
-    if 'chat_sessions' not in st.session_state:
-        st.session_state.chat_sessions = fetch_sessions_from_db(userid) or {}
+    create_tables()
+
+    if 'chat_count' not in st.session_state:
+        st.session_state.chat_count = fetch_chat_count_from_db(userid)
+        if not st.session_state.chat_count:
+            # Chats from the legacy JSON blob, or saved before chat_index existed
+            migrate_sessions_to_messages(userid)
+            backfill_chat_index(userid)
+            st.session_state.chat_count = fetch_chat_count_from_db(userid)
+        # Messages of the chats opened in this session, and how many of them are already stored
+        st.session_state.chat_sessions = {}
+        st.session_state.saved_message_counts = {}
+        migrate_wishlist_to_items(userid)
         
     if 'current_chat' not in st.session_state:
         st.session_state.current_chat = None
@@ -185,12 +410,14 @@ def chatbot():
     # Simulated popup for wishlist
     if st.session_state.get('show_wishlist', False):
         st.subheader(f"Wishlist")
-        wishlist_data = fetch_wishlist_from_db(userid)  # Get the data
-        
-        if "products" in wishlist_data and wishlist_data["products"]:
-            # Display each product image
-            products = wishlist_data["products"]
-            num_columns = 6
+        num_columns = 6
+        page_size = num_columns * 4
+        page = st.session_state.get("wishlist_page", 0)
+        products, total = get_wishlist_page(userid, page, page_size)
+
+        if products:
+            # Display each product image, as a cached thumbnail
+            thumbnail_paths = thumbnails.thumbnails(products)
             rows = len(products) // num_columns + (len(products) % num_columns > 0)
 
             for i in range(rows):
@@ -199,9 +426,28 @@ def chatbot():
                     idx = i * num_columns + j
                     if idx < len(products):
                         with cols[j]:
-                            st.image(products[idx], use_container_width=True)
-            # for product_url in wishlist_data["products"]:
-            #     st.image(product_url, width=200)
+                            st.image(thumbnail_paths[idx], use_container_width=True)
+                            if st.button("remove", key=f"wishlist_remove_{page}_{idx}"):
+                                remove_from_wishlist(userid, products[idx])
+                                st.rerun()
+
+            page_count = (total + page_size - 1) // page_size
+            if page_count > 1:
+                prev_col, info_col, next_col = st.columns([1, 2, 1])
+                with prev_col:
+                    if page > 0 and st.button("Previous", key="wishlist_prev"):
+                        st.session_state.wishlist_page = page - 1
+                        st.rerun()
+                with info_col:
+                    st.write(f"Page {page + 1} of {page_count}")
+                with next_col:
+                    if page + 1 < page_count and st.button("Next", key="wishlist_next"):
+                        st.session_state.wishlist_page = page + 1
+                        st.rerun()
+        elif page > 0:
+            # The last page emptied out, go back one
+            st.session_state.wishlist_page = page - 1
+            st.rerun()
         else:
             st.write("Your wishlist is empty!")
 
@@ -210,33 +456,61 @@ def chatbot():
             st.session_state.show_wishlist = False
 
 
-    # Iterate through chat sessions
+    # List the chats from chat_index, a page at a time, most recently updated first
     friendly_phrases = [
     "Start a conversation! 💬",
     "Let's get started! 😊",
     "Ready to assist you! 🚀"
     ]
-
-    for index, (chat_name, chat_content) in enumerate(st.session_state.chat_sessions.items()):
-        # Find the first user message or pick a random friendly phrase
-        first_user_message = next(
-            (message["content"] for message in chat_content if message["role"] == "user"),
-            random.choice(friendly_phrases)  # Random friendly phrase
-        )
+    chat_page_size = int(os.getenv("CHAT_LIST_PAGE_SIZE", "20"))
+    search = st.sidebar.text_input("Search chats", key="chat_search").strip()
+    if search != st.session_state.get("chat_list_search", ""):
+        st.session_state.chat_list_search = search
+        st.session_state.chat_list_page = 0
+    chat_page = st.session_state.get("chat_list_page", 0)
+    chats, chat_total = get_chat_index_page(userid, search, chat_page, chat_page_size)
+    if not chats and chat_page > 0:
+        # The last page emptied out, go back one
+        st.session_state.chat_list_page = chat_page - 1
+        st.rerun()
+    if search and not chats:
+        st.sidebar.write("No chats match your search.")
+
+    for chat in chats:
+        chat_name = chat["chat_name"]
+        # Use the first user message, or a friendly phrase picked by the chat's name so it stays put across reruns
+        first_user_message = chat["title"] or friendly_phrases[zlib.crc32(chat_name.encode("utf-8")) % len(friendly_phrases)]
         # Truncate long messages for better display
         display_name = first_user_message[:30] + "..." if len(first_user_message) > 30 else first_user_message
-        
-        # Ensure unique key for each button
-        button_key = f"{chat_name}_{index}"  # Combines chat_name and index for uniqueness
+        details = f"{chat['message_count']} messages, last updated {chat['updated_at']:%Y-%m-%d %H:%M}"
 
-        if st.sidebar.button(display_name, key=button_key):
+        if st.sidebar.button(display_name, key=f"chat_{chat_name}", help=details):
             # Save the current chat session before switching
             if st.session_state.current_chat and "messages" in st.session_state:
                 st.session_state.chat_sessions[st.session_state.current_chat] = st.session_state.messages
+            # Load the selected chat's messages the first time it is opened
+            if chat_name not in st.session_state.chat_sessions:
+                messages = fetch_chat_messages_from_db(userid, chat_name)
+                st.session_state.chat_sessions[chat_name] = messages
+                st.session_state.saved_message_counts[chat_name] = len(messages)
             # Switch to the selected chat
             st.session_state.current_chat = chat_name
             st.session_state.messages = st.session_state.chat_sessions[chat_name]
 
+    chat_page_count = (chat_total + chat_page_size - 1) // chat_page_size
+    if chat_page_count > 1:
+        newer_col, older_col = st.sidebar.columns(2)
+        with newer_col:
+            if chat_page > 0 and st.button("Newer", key="chat_list_newer"):
+                st.session_state.chat_list_page = chat_page - 1
+                st.rerun()
+        with older_col:
+            if chat_page + 1 < chat_page_count and st.button("Older", key="chat_list_older"):
+                st.session_state.chat_list_page = chat_page + 1
+                st.rerun()
+        st.sidebar.caption(f"Page {chat_page + 1} of {chat_page_count}")
+
+    start_resource_warm_up()
 
     # Button to start a new chat
     if st.sidebar.button("New Chat"):
@@ -245,14 +519,16 @@ def chatbot():
             st.session_state.chat_sessions[st.session_state.current_chat] = st.session_state.messages
 
         # Create a new chat session
-        new_chat_name = f"{userid}_Chat_{len(st.session_state.chat_sessions) + 1}"
+        new_chat_name = f"{userid}_Chat_{st.session_state.chat_count + 1}"
         st.session_state.current_chat = new_chat_name
         st.session_state.messages = []
+        st.session_state.chat_sessions[new_chat_name] = st.session_state.messages
 
     # Ensure a current chat is set
     if not st.session_state.current_chat:
-        st.session_state.current_chat = f"{userid}_Chat_{len(st.session_state.chat_sessions) + 1}"
+        st.session_state.current_chat = f"{userid}_Chat_{st.session_state.chat_count + 1}"
         st.session_state.messages = []
+        st.session_state.chat_sessions[st.session_state.current_chat] = st.session_state.messages
 
     # Initialize chat messages if it's a new session
     if not st.session_state.messages:
@@ -269,20 +545,39 @@ def chatbot():
 
     st.title(f"Smart Shopping AI Agent")
 
-    # Display chat messages
-    for message_idx, message in enumerate(st.session_state.messages):
-        with st.chat_message(message['role']):
-            st.write(message['content'])
-            if message['role'] == 'assistant' and message['image_urls']:
-                cols = st.columns(4)
-                # for col, img_url in zip(cols, message['image_urls']):
-                for idx, (col, img_url) in enumerate(zip(cols, message['image_urls'])):
-                    with col:
-                        st.image(img_url, caption='Product Image')
-                        if st.button("wishlist", key=f"wishlist_{message_idx}_{idx}"):
-                            wishlist_products = fetch_wishlist_from_db(userid)
-                            wishlist_products["products"].append(img_url)
-                            update_wishlist_to_db(wishlist_products,userid)
+    # Display chat messages. Only the latest page of messages is rendered, and only
+    # the latest turns show their products, so a rerun costs what is on screen.
+    page_size = int(os.getenv("CHAT_MESSAGES_PAGE_SIZE", "10"))
+    expanded_messages = int(os.getenv("CHAT_EXPANDED_MESSAGES", "4"))
+    with metrics.span("render.chat_history"):
+        messages = st.session_state.messages
+        visible_counts = st.session_state.setdefault("visible_message_counts", {})
+        visible_count = visible_counts.get(st.session_state.current_chat, page_size)
+        first_visible = max(len(messages) - visible_count, 0)
+        if first_visible and st.button(f"Show earlier messages ({first_visible} hidden)", key="show_earlier_messages"):
+            visible_counts[st.session_state.current_chat] = visible_count + page_size
+            st.rerun()
+
+        shown_products = st.session_state.setdefault("shown_products", set())
+        for message_idx in range(first_visible, len(messages)):
+            message = messages[message_idx]
+            with st.chat_message(message['role']):
+                st.write(message['content'])
+                if message['role'] == 'assistant' and message['image_urls']:
+                    product_key = (st.session_state.current_chat, message_idx)
+                    if message_idx < len(messages) - expanded_messages and product_key not in shown_products:
+                        # Older turns are collapsed until asked for
+                        if st.button(f"Show {len(message['image_urls'])} products", key=f"show_products_{message_idx}"):
+                            shown_products.add(product_key)
+                            st.rerun()
+                        continue
+                    cols = st.columns(4)
+                    thumbnail_paths = thumbnails.thumbnails(message['image_urls'][:len(cols)])
+                    for idx, (col, img_url, thumbnail_path) in enumerate(zip(cols, message['image_urls'], thumbnail_paths)):
+                        with col:
+                            st.image(thumbnail_path, caption='Product Image')
+                            if st.button("wishlist", key=f"wishlist_{message_idx}_{idx}"):
+                                add_to_wishlist(userid, img_url)
 
     # User input for search prompt
     prompt = st.chat_input("Search...")
@@ -297,48 +592,58 @@ def chatbot():
         # Add user message to session state
         st.session_state.messages.append({"role": "user", "content": prompt})
 
-        with st.spinner("Generating response...."):
-            LLM_response = build_suggestions_json(prompt, context)
+        # The assistant message this turn will add, used for the wishlist button keys
+        message_idx = len(st.session_state.messages)
 
+        # Stream the answer into the chat as it is generated instead of waiting behind a spinner
+        LLM_response = {}
         image_urls = []
-        if LLM_response and 'results' in LLM_response and LLM_response['results']:  # Check if results exist and not empty
-            bot_answer = "These are the products retrieved as per your query!"
-            for item in LLM_response['results']:
-                if 'product_url' in item:  # Add safety check
-                    image_urls.append(item['product_url'])
-        else:
-            # Use the fallback response if available, otherwise use default message
-            bot_answer = LLM_response.get('fallback_response')
-            image_urls = []  # Ensure image_urls is empty
+        with st.chat_message("assistant"):
+            text_placeholder = st.empty()
+            text_placeholder.write("Generating response....")
+            cols = st.columns(4)
+            streamed_text = ""
+            # Reranking history is kept per chat in session state, bounded by a token budget
+            rerank_history = st.session_state.setdefault("rerank_histories", {}).setdefault(st.session_state.current_chat, [])
+            # With WORKER_URL set the pipeline runs in the worker service instead of this script thread.
+            # Imported here so pages that never send a prompt don't load the pipeline modules
+            if os.getenv("WORKER_URL"):
+                from worker import stream_suggestions
+            else:
+                from main import stream_suggestions_sync as stream_suggestions
+            for event, payload in stream_suggestions(prompt, context, rerank_history):
+                if event == "text":
+                    streamed_text += payload
+                    text_placeholder.write(streamed_text)
+                elif event == "result" and 'product_url' in payload and len(image_urls) < len(cols):
+                    img_url = payload['product_url']
+                    with cols[len(image_urls)]:
+                        st.image(img_url, caption='Product Image')
+                        wishlist_button_key = f"wishlist_{message_idx}_{len(image_urls)}"
+                        if st.button("wishlist", key=wishlist_button_key):
+                            add_to_wishlist(userid, img_url)
+                    image_urls.append(img_url)
+                elif event == "done":
+                    LLM_response = payload or {}
+                elif event == "error":
+                    # The pipeline or the worker service failed; no products this turn
+                    LLM_response = {}
+
+            if LLM_response and 'results' in LLM_response and LLM_response['results']:  # Check if results exist and not empty
+                bot_answer = "These are the products retrieved as per your query!"
+            else:
+                # Use the fallback response if available, otherwise use default message
+                bot_answer = LLM_response.get('fallback_response')
+                if not bot_answer:
+                    from main import UNAVAILABLE_MESSAGE
+                    bot_answer = UNAVAILABLE_MESSAGE
+                image_urls = []  # Ensure image_urls is empty
+            text_placeholder.write(bot_answer)
 
         st.session_state.messages.append({"role": "assistant", "content": bot_answer, "image_urls": image_urls})
 
-        # with st.chat_message("assistant"):
-        #     st.write(bot_answer)
-        #     if image_urls:
-        #         cols = st.columns(len(image_urls))
-        #         for col, img_url in zip(cols, image_urls):
-        #             with col:
-        #                 st.image(img_url, caption='Product Image', use_container_width='auto')
-
-        with st.chat_message("assistant"):
-            st.write(bot_answer)
-            if image_urls:
-                cols = st.columns(4)
-                for idx, (col, img_url) in enumerate(zip(cols, image_urls)):
-                        with col:
-                            st.image(img_url, caption='Product Image')
-                            wishlist_button_key = f"wishlist_{len(st.session_state.messages)-1}_{idx}"
-                            if st.button("wishlist", key=wishlist_button_key):
-                                print("button clicked!!!!!!!!!!!!!!")
-                                # st.session_state[wishlist_button_key] = False
-                                print("buttoon clicked \n\n\n\n\n")
-                                wishlist_products = fetch_wishlist_from_db(userid)
-                                wishlist_products["products"].append(img_url)
-                                update_wishlist_to_db(wishlist_products,userid)
-
 
-    update_sessions_to_db(st.session_state.chat_sessions, userid)
+    save_new_messages(userid)
 
 def logout_session():
     st.query_params.clear() 
@@ -363,4 +668,5 @@ def logout_session():
 
 
 if __name__ == "__main__":
-    chatbot()
+    with metrics.span("render.rerun"):
+        chatbot()
@@ -0,0 +1,162 @@
+import os
+import re
+
+# Vocabulary of the apparel catalog, mapping each surface form to a canonical value
+CATEGORIES = {
+    "tshirt": "tshirt", "tee": "tshirt", "polo": "tshirt",
+    "shirt": "shirt",
+    "top": "top", "blouse": "top", "tunic": "top",
+    "kurta": "kurta", "kurti": "kurta",
+    "saree": "saree", "sari": "saree",
+    "dress": "dress", "gown": "dress",
+    "skirt": "skirt",
+    "jean": "jeans", "jeans": "jeans", "denim": "jeans",
+    "trouser": "trousers", "trousers": "trousers", "pant": "trousers", "pants": "trousers", "chino": "trousers",
+    "short": "shorts", "shorts": "shorts",
+    "legging": "leggings", "leggings": "leggings",
+    "jacket": "jacket", "blazer": "blazer", "coat": "coat",
+    "sweater": "sweater", "sweatshirt": "sweatshirt", "hoodie": "sweatshirt", "cardigan": "sweater",
+    "shoe": "shoes", "shoes": "shoes", "sneaker": "sneakers", "sneakers": "sneakers", "loafer": "shoes",
+    "boot": "boots", "boots": "boots",
+    "sandal": "sandals", "sandals": "sandals",
+    "slipper": "flip-flops", "flipflop": "flip-flops", "flip-flop": "flip-flops",
+    "heel": "heels", "heels": "heels",
+    "watch": "watch", "bag": "bag", "handbag": "bag", "backpack": "bag", "wallet": "wallet",
+    "cap": "cap", "hat": "cap", "belt": "belt", "sock": "socks", "socks": "socks",
+    "footwear": "footwear",
+}
+
+COLORS = {
+    "black", "white", "blue", "navy", "red", "maroon", "green", "olive", "yellow", "mustard",
+    "orange", "pink", "purple", "lavender", "grey", "gray", "brown", "beige", "cream",
+    "khaki", "gold", "silver", "teal", "peach", "multi",
+}
+
+GENDERS = {
+    "men": "men", "man": "men", "mens": "men", "male": "men", "boy": "boys", "boys": "boys",
+    "women": "women", "woman": "women", "womens": "women", "female": "women", "ladies": "women",
+    "girl": "girls", "girls": "girls", "kid": "kids", "kids": "kids", "unisex": "unisex",
+}
+
+
+def tokenize(text):
+    # "T-Shirts" and "t shirts" should both read as tshirts
+    text = re.sub(r"\bt[\s-]?shirt", "tshirt", text.lower())
+    text = text.replace("flip flop", "flipflop")
+    return re.findall(r"[a-z0-9-]+", text.replace("'", ""))
+
+
+def _singular(token):
+    if token.endswith("es") and token[:-2] in CATEGORIES:
+        return token[:-2]
+    if token.endswith("s") and token[:-1] in CATEGORIES:
+        return token[:-1]
+    return token
+
+
+def canonical_category(token):
+    return CATEGORIES.get(_singular(token))
+
+
+def canonical_color(token):
+    if token not in COLORS:
+        return None
+    return "grey" if token == "gray" else token
+
+
+def parse_attributes(text):
+    """Category, color and gender mentioned in text, each None when absent."""
+    attributes = {"category": None, "color": None, "gender": None}
+    for token in tokenize(text):
+        if attributes["category"] is None and canonical_category(token):
+            attributes["category"] = canonical_category(token)
+        elif attributes["color"] is None and canonical_color(token):
+            attributes["color"] = canonical_color(token)
+        elif attributes["gender"] is None and token in GENDERS:
+            attributes["gender"] = GENDERS[token]
+    return attributes
+
+
+def _price_bounds():
+    # Upper bounds of the price bands, e.g. "500,1000,2000,5000"
+    return [int(bound) for bound in os.getenv("PRICE_BANDS", "500,1000,2000,5000").split(",") if bound.strip()]
+
+
+def _band_label(index, bounds):
+    low = bounds[index - 1] if index else 0
+    return f"{low}-{bounds[index]}" if index < len(bounds) else f"{low}+"
+
+
+def price_band(price):
+    if price is None:
+        return None
+    bounds = _price_bounds()
+    index = next((i for i, bound in enumerate(bounds) if float(price) < bound), len(bounds))
+    return _band_label(index, bounds)
+
+
+def price_bands_between(low, high, include_high=True):
+    """Labels of every band overlapping the price range [low, high], or [low, high) without include_high."""
+    bounds = _price_bounds()
+    labels = []
+    for index in range(len(bounds) + 1):
+        band_low = bounds[index - 1] if index else 0
+        band_high = bounds[index] if index < len(bounds) else float("inf")
+        # A band starts at its lower bound, so "under 1000" mustn't take in the one from 1000
+        below_high = band_low <= high if include_high else band_low < high
+        if below_high and band_high > low:
+            labels.append(_band_label(index, bounds))
+    return labels
+
+
+def extract_metadata(description, price=None):
+    """Filterable attributes of a catalog product, stored as vector metadata.
+
+    Values are lists since a description can name more than one color. A
+    product that names no gender is stored as unisex, which every gender
+    filter accepts.
+    """
+    tokens = tokenize(description)
+    metadata = {
+        "category": sorted({canonical_category(token) for token in tokens if canonical_category(token)}),
+        "color": sorted({canonical_color(token) for token in tokens if canonical_color(token)}),
+        "gender": sorted({GENDERS[token] for token in tokens if token in GENDERS}) or ["unisex"],
+    }
+    metadata = {key: values for key, values in metadata.items() if values}
+    band = price_band(price)
+    if band:
+        metadata["price_band"] = band
+    return metadata
+
+
+def parse_price_range(text):
+    """(low, high, include_high) from phrases like "under 1000", "up to 1000" or "above 500", None if there is none."""
+    text = text.lower().replace(",", "")
+    match = re.search(r"\b(?:under|below|less than)\s*(?:rs\.?|inr|₹|\$)?\s*(\d+)", text)
+    if match:
+        return 0, int(match.group(1)), False
+    match = re.search(r"\b(?:up to|upto|within|max)\s*(?:rs\.?|inr|₹|\$)?\s*(\d+)", text)
+    if match:
+        return 0, int(match.group(1)), True
+    match = re.search(r"\b(?:above|over|more than|min)\s*(?:rs\.?|inr|₹|\$)?\s*(\d+)", text)
+    if match:
+        return int(match.group(1)), float("inf"), True
+    return None
+
+
+def query_filter(text):
+    """Metadata filter for the attributes text asks for, in Pinecone's filter syntax, or None."""
+    attributes = parse_attributes(text)
+    conditions = []
+    if attributes["category"]:
+        conditions.append({"category": {"$in": [attributes["category"]]}})
+    if attributes["color"]:
+        conditions.append({"color": {"$in": [attributes["color"]]}})
+    if attributes["gender"] and attributes["gender"] != "unisex":
+        conditions.append({"gender": {"$in": [attributes["gender"], "unisex"]}})
+    price_range = parse_price_range(text)
+    if price_range:
+        conditions.append({"price_band": {"$in": price_bands_between(*price_range)}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
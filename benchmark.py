@@ -0,0 +1,564 @@
+"""Offline benchmark for the suggestion pipeline and the app.py DB helpers.
+
+OpenAI, Pinecone and the embedding model are replaced by in-process fakes
+with configurable latency, so runs are repeatable and cost nothing. The DB
+helpers run against a local Postgres given with --db-url.
+
+    python benchmark.py --conversations 200 --concurrency 8
+    python benchmark.py --save-baseline main
+    python benchmark.py --compare main
+
+--embedding-modes compares real embedding models and modes instead (recall of
+each against the first, encode latency), e.g.
+
+    python benchmark.py --embedding-modes all-mpnet-base-v2:float32,all-mpnet-base-v2:int8,all-MiniLM-L6-v2:float32
+
+--startup measures how long importing app.py and the pipeline modules takes,
+each in a fresh interpreter, and fails if app.py goes over --import-budget-ms
+or loads an ML/API client library before the login check.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+import metrics
+import resources
+from attributes import CATEGORIES, COLORS, GENDERS, extract_metadata, parse_attributes, tokenize
+from retrieval import matches_filter
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baselines")
+
+
+# ------------------------------------------------------------------------------------------
+# Stand-ins
+
+class Latency:
+    def __init__(self, mean, jitter):
+        self.mean = mean
+        self.jitter = jitter
+
+    def sample(self):
+        return max(0.0, random.gauss(self.mean, self.jitter))
+
+    def sleep(self):
+        time.sleep(self.sample())
+
+    async def async_sleep(self):
+        await asyncio.sleep(self.sample())
+
+
+class FakeEncoder:
+    """Hashes words into a normalized bag-of-words vector, so similar texts land close together.
+
+    Like a CPU-bound model, one encode call runs at a time and each extra text
+    in a batch costs a fraction of a call.
+    """
+
+    def __init__(self, dim, latency, per_item_fraction=0.1):
+        self.dim = dim
+        self.latency = latency
+        self.per_item_fraction = per_item_fraction
+        self._cpu = threading.Lock()
+
+    def _encode_one(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % self.dim] += 1.0
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        with self._cpu:
+            self.latency.sleep()
+            if not isinstance(texts, str) and len(texts) > 1:
+                time.sleep(self.latency.mean * self.per_item_fraction * (len(texts) - 1))
+        if isinstance(texts, str):
+            return self._encode_one(texts)
+        return np.stack([self._encode_one(text) for text in texts])
+
+
+def build_catalog(size, seed=0):
+    rng = random.Random(seed)
+    categories = sorted(set(CATEGORIES.values()))
+    genders = sorted(set(GENDERS.values()))
+    materials = ["cotton", "leather", "denim", "linen", "silk", "wool", "polyester", "canvas"]
+    styles = ["formal", "casual", "party", "sports", "ethnic", "slim fit", "regular fit"]
+    catalog = []
+    for i in range(size):
+        description = (
+            f"{rng.choice(genders).title()} {rng.choice(sorted(COLORS)).title()} "
+            f"{rng.choice(materials).title()} {rng.choice(styles).title()} {rng.choice(categories).title()}"
+        )
+        catalog.append({
+            "id": str(i), "description": description, "uri": f"https://cdn.example.com/products/{i}.jpg",
+            "metadata": extract_metadata(description, rng.randrange(200, 8000)),
+        })
+    return catalog
+
+
+class FakeIndex:
+    """Pinecone Index stand-in doing exact search over the fake catalog."""
+
+    def __init__(self, catalog, vectors, latency):
+        self.catalog = catalog
+        self.vectors = vectors
+        self.latency = latency
+
+    def query(self, vector, top_k, filter=None, include_values=False, include_metadata=True, **kwargs):
+        self.latency.sleep()
+        scores = self.vectors @ np.asarray(vector, dtype=np.float32)
+        if filter:
+            allowed = np.array([matches_filter(product["metadata"], filter) for product in self.catalog])
+            scores = np.where(allowed, scores, -np.inf)
+        best = [row for row in np.argsort(-scores)[:top_k] if np.isfinite(scores[row])]
+        matches = []
+        for row in best:
+            product = self.catalog[row]
+            match = {"id": product["id"], "score": float(scores[row]),
+                     "metadata": {"description": product["description"], "uri": product["uri"], **product["metadata"]}}
+            if include_values:
+                match["values"] = self.vectors[row].tolist()
+            matches.append(match)
+        return {"matches": matches}
+
+    def upsert(self, vectors, **kwargs):
+        self.latency.sleep()
+
+    def fetch(self, ids, **kwargs):
+        # No embedding manifest, the fake catalog is always encoded with the fake encoder
+        return {"vectors": {}}
+
+
+def _usage(messages, completion):
+    prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 4
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(completion) // 4)
+
+
+def _fake_rewrite(prompt):
+    context = re.search(r"Previous queries: (.*)", prompt).group(1)
+    user_query = re.search(r"Current query: (.*)", prompt).group(1).strip()
+    if parse_attributes(user_query)["category"] is None:
+        # Carry the latest product the user asked about over to this query
+        for query in reversed(re.findall(r"'([^']*)'", context)):
+            category = parse_attributes(query)["category"]
+            if category:
+                return f"{category} with {user_query}"
+    return user_query
+
+
+def _fake_rerank(messages):
+    import rerank
+
+    content = messages[-1]["content"]
+    query = re.search(r"Search query: (.*)", content).group(1)
+    # Candidates are numbered lines; the number stands in for the product in the answer
+    products = [
+        {"uri": number, "description": description}
+        for number, description in re.findall(r"^(\d+)\. (.*)$", content, re.MULTILINE)
+    ]
+    suggestions_json, _ = rerank.rerank(query, products)
+    if suggestions_json is None:
+        return json.dumps({"query": query, "results": [], "fallback_response": "Sorry, I couldn't find a product matching that. Could you describe it differently?"})
+    results = [{"id": int(item["product_url"]), "match_percentage": item["match_percentage"]} for item in suggestions_json["results"]]
+    return json.dumps({"query": query, "results": results})
+
+
+def _completion(messages, functions):
+    last = messages[-1]["content"]
+    if functions:
+        arguments = _fake_rerank(messages)
+        message = SimpleNamespace(content=None, function_call=SimpleNamespace(name="suggestions", arguments=arguments))
+        return message, arguments
+    text = _fake_rewrite(last)
+    return SimpleNamespace(content=text, function_call=None), text
+
+
+class FakeOpenAI:
+    def __init__(self, latency):
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, functions=None, **kwargs):
+        self.latency.sleep()
+        message, text = _completion(messages, functions)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=_usage(messages, text))
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, latency, token_latency):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, functions=None, stream=False, **kwargs):
+        await self.latency.async_sleep()
+        message, text = _completion(messages, functions)
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=_usage(messages, text))
+        return self._stream(messages, text, bool(functions))
+
+    async def _stream(self, messages, text, is_function_call):
+        for start in range(0, len(text), 16):
+            await asyncio.sleep(self.token_latency)
+            piece = text[start:start + 16]
+            delta = SimpleNamespace(
+                content=None if is_function_call else piece,
+                function_call=SimpleNamespace(arguments=piece) if is_function_call else None
+            )
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=_usage(messages, text))
+
+
+def install_fakes(args):
+    catalog = build_catalog(args.catalog_size)
+    encoder = FakeEncoder(args.dim, Latency(args.encode_latency, args.encode_latency / 4))
+    vectors = np.stack([encoder._encode_one(product["description"]) for product in catalog])
+
+    resources.override("model", encoder)
+    resources.override("openai_client", FakeOpenAI(Latency(args.llm_latency, args.llm_jitter)))
+    resources.override("async_openai_client", FakeAsyncOpenAI(Latency(args.llm_latency, args.llm_jitter), args.token_latency))
+
+    if args.backend == "local":
+        from retrieval import LocalBackend, LocalIndexWriter
+
+        directory = os.path.join(tempfile.mkdtemp(prefix="bench-index-"), "index")
+        writer = LocalIndexWriter(directory, keep_existing=False)
+        writer.add([p["id"] for p in catalog], vectors, [{"description": p["description"], "uri": p["uri"], **p["metadata"]} for p in catalog])
+        writer.close()
+        resources.override("retrieval_backend", LocalBackend(directory))
+    else:
+        from retrieval import PineconeBackend
+
+        index = FakeIndex(catalog, vectors, Latency(args.index_latency, args.index_latency / 4))
+        resources.override("pinecone_index", index)
+        resources.override("retrieval_backend", PineconeBackend(index))
+
+    if args.hybrid:
+        from keyword_index import KeywordIndex
+
+        keyword_index = KeywordIndex(os.path.join(tempfile.mkdtemp(prefix="bench-keywords-"), "keywords.sqlite"))
+        keyword_index.add(
+            [p["id"] for p in catalog],
+            [p["description"] for p in catalog],
+            [{"description": p["description"], "uri": p["uri"], **p["metadata"]} for p in catalog]
+        )
+        resources.override("keyword_index", keyword_index)
+    else:
+        resources.override("keyword_index", None)
+    return catalog
+
+
+# ------------------------------------------------------------------------------------------
+# Corpus
+
+def synthetic_corpus(conversations, seed=1):
+    """Multi-turn conversations shaped like real sessions: a product, then refinements."""
+    rng = random.Random(seed)
+    categories = sorted(set(CATEGORIES.values()))
+    colors = sorted(COLORS)
+    genders = ["men", "women", "boys", "girls"]
+    corpus = []
+    for _ in range(conversations):
+        turns = []
+        for _ in range(rng.randint(1, 3)):
+            turns.append(rng.choice([f"I want {rng.choice(categories)}", f"show me {rng.choice(categories)}", rng.choice(categories)]))
+            if rng.random() < 0.6:
+                turns.append(f"{rng.choice(colors)} color")
+            if rng.random() < 0.3:
+                turns.append(f"for {rng.choice(genders)}")
+        corpus.append(turns)
+    # Popular sessions repeat, which is what the caches are for
+    return corpus + [rng.choice(corpus) for _ in range(conversations // 4)]
+
+
+def load_corpus(path):
+    # One JSON object per line, {"turns": [...]}, or a bare list of turns
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                corpus.append(entry["turns"] if isinstance(entry, dict) else entry)
+    return corpus
+
+
+# ------------------------------------------------------------------------------------------
+# Runners
+
+def run_conversation(turns, mode):
+    from main import build_suggestions_json, stream_suggestions_sync
+
+    latencies = []
+    history = []
+    context = []
+    for turn in turns:
+        start = time.perf_counter()
+        if mode == "stream":
+            for _ in stream_suggestions_sync(turn, list(context), history):
+                pass
+        else:
+            build_suggestions_json(turn, list(context), history)
+        latencies.append(time.perf_counter() - start)
+        context.append(turn)
+    return latencies
+
+
+def run_db_conversation(turns, userid):
+    import app
+
+    latencies = []
+    start = time.perf_counter()
+    if not app.check_user_in_db(userid):
+        app.add_user_to_db(userid)
+    latencies.append(time.perf_counter() - start)
+    chat_name = f"{userid}_Chat_1"
+    for position, turn in enumerate(turns):
+        start = time.perf_counter()
+        app.append_messages_to_db(userid, chat_name, position * 2, [
+            {"role": "user", "content": turn},
+            {"role": "assistant", "content": "These are the products retrieved as per your query!", "image_urls": []},
+        ])
+        app.fetch_chat_index_page_from_db(userid, "", 20, 0)
+        app.add_to_wishlist_db(userid, f"https://cdn.example.com/products/{position}.jpg")
+        app.fetch_wishlist_page_from_db(userid, 24, 0)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def summarize(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "qps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run(args, corpus):
+    report = {"config": {key: value for key, value in vars(args).items() if key not in ("save_baseline", "compare")}}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda turns: run_conversation(turns, args.mode), corpus))
+    report["pipeline"] = summarize([latency for latencies in results for latency in latencies], time.perf_counter() - start)
+
+    if args.db_url:
+        os.environ["NEON_DB_URL"] = args.db_url
+        import app
+
+        app.create_tables()
+        base_userid = 900000000 + random.randrange(1000000) * 100
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda item: run_db_conversation(item[1], base_userid + item[0]), enumerate(corpus)))
+        report["db"] = summarize([latency for latencies in results for latency in latencies], time.perf_counter() - start)
+
+    report["stages"] = {
+        name: {key.replace("_seconds", "_ms"): round(value * 1000, 3) if key.endswith("_seconds") else value for key, value in stats.items()}
+        for name, stats in metrics.summary().items()
+    }
+    report["tokens"] = metrics.token_summary()
+    batcher = resources.get_embedding_batcher()
+    if batcher is not None:
+        report["embedding_batcher"] = batcher.stats()
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return report
+
+
+# ------------------------------------------------------------------------------------------
+# Baselines
+
+def compare_embedding_modes(specs, corpus, catalog_size, top_k=10):
+    """Recall@top_k of each model:mode[:dim] spec against the first one, plus encode timings."""
+    from embedding import load_model
+
+    descriptions = [product["description"] for product in build_catalog(catalog_size)]
+    queries = list(dict.fromkeys(turn for turns in corpus for turn in turns))[:200]
+    reference = None
+    report = {"catalog_size": catalog_size, "queries": len(queries), "modes": {}}
+    for spec in specs:
+        model_name, mode, *dim = spec.split(":")
+        dim = int(dim[0]) if dim else None
+        start = time.perf_counter()
+        model = load_model(model_name, mode, dim)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        catalog_vectors = np.asarray(model.encode(descriptions, batch_size=64, normalize_embeddings=True))
+        catalog_seconds = time.perf_counter() - start
+
+        query_latencies = []
+        query_vectors = []
+        for query in queries:
+            start = time.perf_counter()
+            query_vectors.append(model.encode(query, normalize_embeddings=True))
+            query_latencies.append(time.perf_counter() - start)
+
+        scores = np.asarray(query_vectors) @ catalog_vectors.T
+        results = [set(np.argsort(-row)[:top_k]) for row in scores]
+        if reference is None:
+            reference = results
+        recall = statistics.mean(len(result & expected) / top_k for result, expected in zip(results, reference))
+
+        report["modes"][spec] = {
+            "dim": int(catalog_vectors.shape[1]),
+            f"recall@{top_k}": round(recall, 4),
+            "load_seconds": round(load_seconds, 2),
+            "catalog_rows_per_second": round(len(descriptions) / catalog_seconds, 1),
+            "query_p50_ms": round(percentile(query_latencies, 0.5) * 1000, 3),
+            "query_p95_ms": round(percentile(query_latencies, 0.95) * 1000, 3),
+            # Process-wide peak, so it only grows across the specs; compare modes in separate runs for memory
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        print(spec, report["modes"][spec])
+    return report
+
+
+# Libraries app.py must not load until a prompt actually needs the pipeline
+HEAVY_MODULES = ("torch", "sentence_transformers", "transformers", "onnxruntime", "openai", "pinecone")
+
+
+def measure_import(module):
+    """Import module in a fresh interpreter; its import time, the heavy modules it loaded and its slowest imports."""
+    code = f"import json, sys; import {module}; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    total_us = next(cumulative for name, _, cumulative in imports if name == module)
+    return {
+        "import_ms": round(total_us / 1000, 1),
+        "heavy_modules": json.loads(result.stdout.strip().splitlines()[-1]),
+        "slowest": {name: round(self_us / 1000, 1) for name, self_us, _ in sorted(imports, key=lambda item: -item[1])[:5]},
+    }
+
+
+def run_startup(budget_ms):
+    report = {"startup": {module: measure_import(module) for module in ("app", "main", "worker")}}
+    app_import = report["startup"]["app"]
+    ok = "error" not in app_import and app_import["import_ms"] <= budget_ms and not app_import["heavy_modules"]
+    report["startup"]["budget_ms"] = budget_ms
+    report["startup"]["within_budget"] = ok
+    return report, ok
+
+
+def save_baseline(name, report):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Baseline saved to {path}")
+
+
+def compare(name, report, tolerance):
+    """Print the change against a saved baseline and return False on a regression."""
+    with open(os.path.join(BASELINE_DIR, f"{name}.json")) as f:
+        baseline = json.load(f)
+    ok = True
+    for section in ("pipeline", "db"):
+        if section not in report or section not in baseline:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "qps"):
+            old, new = baseline[section][key], report[section][key]
+            change = (new - old) / old if old else 0.0
+            # Latency going up or throughput going down past the tolerance is a regression
+            worse = change < -tolerance if key == "qps" else change > tolerance
+            ok = ok and not worse
+            print(f"{section:>8} {key:>7}: {old:10.2f} -> {new:10.2f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+    for module, stats in report.get("startup", {}).items():
+        old_stats = baseline.get("startup", {}).get(module)
+        if not isinstance(stats, dict) or not isinstance(old_stats, dict) or "import_ms" not in stats or "import_ms" not in old_stats:
+            continue
+        old, new = old_stats["import_ms"], stats["import_ms"]
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance
+        ok = ok and not worse
+        print(f"{module:>8} import: {old:10.2f} -> {new:10.2f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--corpus", help="JSONL file of conversations, one list of turns per line")
+    parser.add_argument("--mode", choices=["sync", "stream"], default="sync")
+    parser.add_argument("--backend", choices=["pinecone", "local"], default="pinecone")
+    parser.add_argument("--hybrid", action="store_true", help="fuse BM25 keyword results with the dense ones")
+    parser.add_argument("--catalog-size", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--llm-latency", type=float, default=0.6, help="mean seconds per OpenAI call")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds between streamed chunks")
+    parser.add_argument("--index-latency", type=float, default=0.08, help="mean seconds per Pinecone query")
+    parser.add_argument("--encode-latency", type=float, default=0.03, help="mean seconds per encode call")
+    parser.add_argument("--db-url", default=os.getenv("BENCH_DB_URL"), help="local Postgres for the DB helper benchmark")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--embedding-modes", help="comma-separated model:mode[:dim] specs to compare, the first is the reference")
+    parser.add_argument("--startup", action="store_true", help="measure import times instead of the pipeline")
+    parser.add_argument("--import-budget-ms", type=float, default=float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "1500")))
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.startup:
+        report, ok = run_startup(args.import_budget_ms)
+        print(json.dumps(report, indent=2))
+        if args.save_baseline:
+            save_baseline(args.save_baseline, report)
+        if args.compare and not compare(args.compare, report, args.tolerance):
+            ok = False
+        if not ok:
+            raise SystemExit(1)
+        return
+
+    if args.embedding_modes:
+        corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.conversations)
+        report = compare_embedding_modes(args.embedding_modes.split(","), corpus, args.catalog_size)
+        print(json.dumps(report, indent=2))
+        return
+
+    install_fakes(args)
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.conversations)
+    report = run(args, corpus)
+    print(json.dumps({key: report[key] for key in report if key != "config"}, indent=2))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, report)
+    if args.compare and not compare(args.compare, report, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
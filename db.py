@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+
+import metrics
+import resources
+
+# Shared pool of connections to the Neon session/wishlist database, created on
+# first use and reused by every session and rerun in the process
+_pool = None
+_pool_lock = threading.Lock()
+_slots = None
+_last_used = {}
+
+
+def _get_pool():
+    global _pool, _slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                resources.configure()
+                max_connections = int(os.getenv("DB_POOL_MAX", "5"))
+                _pool = pg_pool.ThreadedConnectionPool(
+                    int(os.getenv("DB_POOL_MIN", "1")),
+                    max_connections,
+                    os.getenv("NEON_DB_URL")
+                )
+                # ThreadedConnectionPool raises instead of waiting when it runs
+                # out, so callers queue on this semaphore first
+                _slots = threading.BoundedSemaphore(max_connections)
+    return _pool
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if id(conn) not in _last_used:
+        # Opened by the pool for this checkout
+        return True
+    # Only ping connections that sat idle long enough for Neon to drop them
+    idle = time.monotonic() - _last_used[id(conn)]
+    if idle < float(os.getenv("DB_HEALTHCHECK_IDLE_SECONDS", "30")):
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool):
+    conn = pool.getconn()
+    if not _is_healthy(conn):
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+def _record(name, seconds, failed):
+    metrics.observe(f"db.{name}", seconds, error=failed)
+
+
+@contextmanager
+def connection(name="db"):
+    """Borrow a pooled connection, committing on success and rolling back on error.
+
+    Connections that fail with a connection-level error are closed instead of
+    being returned, so the next caller gets a fresh one.
+    """
+    pool = _get_pool()
+    start = time.perf_counter()
+    failed = False
+    broken = False
+    timeout = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+    if not _slots.acquire(timeout=timeout):
+        _record(name, time.perf_counter() - start, True)
+        raise TimeoutError(f"No database connection available after {timeout}s")
+
+    try:
+        try:
+            conn = _checkout(pool)
+        except psycopg2.Error:
+            failed = True
+            raise
+
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            failed = broken = True
+            raise
+        except Exception:
+            failed = True
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if broken or conn.closed:
+                _last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn)
+    finally:
+        _slots.release()
+        _record(name, time.perf_counter() - start, failed)
+
+
+def stats():
+    return metrics.summary(prefix="db.")
@@ -0,0 +1,89 @@
+import os
+
+# EMBEDDING_MODE values. int8 quantizes the model's Linear layers for CPU
+# inference; the onnx modes run it on onnxruntime (needs optimum[onnxruntime]).
+MODES = ("float32", "int8", "onnx", "onnx-int8")
+
+
+def _onnx_file(mode):
+    # The sentence-transformers hub models ship exported and pre-quantized ONNX files
+    if mode == "onnx-int8":
+        return os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+    return "onnx/model.onnx"
+
+
+def prepare_artifact(model, mode):
+    """Local copy of the model files under MODEL_ARTIFACT_DIR, downloaded on first use.
+
+    A cold start then loads one local directory instead of resolving the model
+    on the Hugging Face hub. Only the files the mode needs are fetched. Returns
+    None when MODEL_ARTIFACT_DIR isn't set.
+    """
+    directory = os.getenv("MODEL_ARTIFACT_DIR")
+    if not directory:
+        return None
+    path = os.path.join(directory, model.replace("/", "--"))
+    marker = os.path.join(path, f".complete-{mode}")
+    if os.path.exists(marker):
+        return path
+
+    from huggingface_hub import snapshot_download
+
+    patterns = ["*.json", "*.txt", "*.model", "1_Pooling/*", "2_Dense/*", "2_Normalize/*"]
+    if mode.startswith("onnx"):
+        patterns.append(_onnx_file(mode))
+    else:
+        patterns += ["model.safetensors", "pytorch_model.bin"]
+    repo_id = model if "/" in model else f"sentence-transformers/{model}"
+    snapshot_download(repo_id=repo_id, local_dir=path, allow_patterns=patterns)
+    open(marker, "w").close()
+    print(f"Saved {model} ({mode}) to {path}")
+    return path
+
+
+def load_model(model, mode="float32", dim=None):
+    """A SentenceTransformer for model in the given mode, truncated to dim outputs when set."""
+    from sentence_transformers import SentenceTransformer
+
+    if mode not in MODES:
+        raise ValueError(f"Unknown EMBEDDING_MODE {mode!r}, expected one of {', '.join(MODES)}.")
+    source = prepare_artifact(model, mode) or model
+    if mode.startswith("onnx"):
+        return SentenceTransformer(source, backend="onnx", truncate_dim=dim, model_kwargs={"file_name": _onnx_file(mode)})
+
+    encoder = SentenceTransformer(source, device="cpu" if mode == "int8" else None, truncate_dim=dim)
+    if mode == "int8":
+        import torch
+        encoder = torch.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    return encoder
+
+
+def manifest(config, dim):
+    """What an index records about the embeddings it holds."""
+    return {"model": config["model"], "mode": config["mode"], "truncate_dim": config["dim"], "dim": dim}
+
+
+def check_compatible(index_manifest, config, index_name):
+    """Raise ValueError if vectors from config can't be searched in an index built per index_manifest."""
+    if index_manifest is None:
+        print(f"{index_name} doesn't record its embedding model, assuming it matches {config['model']}")
+        return
+    if index_manifest["model"] != config["model"] or index_manifest.get("truncate_dim") != config["dim"]:
+        raise ValueError(
+            f"{index_name} holds {index_manifest['dim']}-dimensional {index_manifest['model']} embeddings "
+            f"but queries would use {config['model']} with EMBEDDING_DIM={config['dim']}. "
+            f"Re-index with pinecone_setup.py --full or change EMBEDDING_MODEL/EMBEDDING_DIM back."
+        )
+    if index_manifest.get("mode") != config["mode"]:
+        # Same model and dimension, only the numeric precision differs: close enough to search
+        print(f"{index_name} was built in {index_manifest.get('mode')} mode, querying in {config['mode']} mode")
+
+
+if __name__ == "__main__":
+    # Precompute the artifact for the configured model, e.g. while building the image:
+    #   MODEL_ARTIFACT_DIR=/models python embedding.py
+    import resources
+
+    config = resources.embedding_config()
+    if not prepare_artifact(config["model"], config["mode"]):
+        raise SystemExit("Set MODEL_ARTIFACT_DIR to where the model should be saved")
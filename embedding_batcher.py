@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+class EmbeddingBatcher:
+    """Collects concurrent query embeddings into one encode call.
+
+    encode() blocks the calling thread until its vector is ready. A background
+    thread takes the first waiting text, keeps collecting for up to max_wait
+    seconds or until max_batch texts are waiting, then encodes them together.
+    """
+
+    def __init__(self, encode_batch, max_batch=16, max_wait=0.005):
+        self.encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self.encode_seconds = 0.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def encode(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                vectors = self.encode_batch([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - start
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+            metrics.observe("embedding.batch", elapsed, size=len(batch))
+            metrics.count("embedding.batch_items", len(batch))
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.encode_seconds += elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+                # Texts encoded per second of encoding, which batching should raise
+                "items_per_encode_second": self.items / self.encode_seconds if self.encode_seconds else 0.0,
+            }
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+
+def normalize_query(text):
+    # The rewrite LLM often wraps its answer in quotes or changes casing,
+    # none of which changes what we want to embed
+    text = text.strip().strip("\"'`").strip()
+    return re.sub(r"\s+", " ", text).lower()
+
+
+class EmbeddingCache:
+    """Bounded LRU/TTL cache of query embeddings, optionally backed by a memory-mapped file.
+
+    Vectors live in a fixed (max_entries, dim) matrix; the LRU order maps each
+    key to its slot in that matrix. With a path, the matrix is a np.memmap and
+    the slot table is kept next to it, so entries survive restarts: a JSON file
+    rewritten every max_entries stores, plus a log of the stores since.
+    """
+
+    def __init__(self, model_name, max_entries=2048, ttl_seconds=86400, path=None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (slot, stored_at)
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._vectors = None
+        self._dim = None
+        self._log = None
+        self._logged = 0
+        self._lock = threading.Lock()
+
+        if self.path:
+            self._load()
+
+    def _key(self, text):
+        return hashlib.sha1(f"{self.model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _index_path(self):
+        return self.path + ".json"
+
+    def _log_path(self):
+        return self.path + ".log"
+
+    def _allocate(self, dim):
+        self._dim = dim
+        if self.path:
+            mode = "r+" if os.path.exists(self.path) else "w+"
+            self._vectors = np.memmap(self.path, dtype=np.float32, mode=mode, shape=(self.max_entries, dim))
+            if mode == "w+":
+                self._save()
+        else:
+            self._vectors = np.zeros((self.max_entries, dim), dtype=np.float32)
+
+    def _load(self):
+        if not (os.path.exists(self.path) and os.path.exists(self._index_path())):
+            return
+        try:
+            with open(self._index_path()) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable embedding cache index {self._index_path()}: {e}")
+            return
+
+        # A cache written for another model or size can't be reused
+        if saved.get("model_name") != self.model_name or saved.get("max_entries") != self.max_entries:
+            print("Embedding cache on disk was built with different settings, starting empty")
+            return
+
+        self._allocate(saved["dim"])
+        entries = OrderedDict((key, (slot, stored_at)) for key, slot, stored_at in saved["entries"])
+        # Replay the stores made since the table was written; a slot belongs to whichever key took it last
+        keys_by_slot = {slot: key for key, (slot, _) in entries.items()}
+        if os.path.exists(self._log_path()):
+            with open(self._log_path()) as f:
+                for line in f:
+                    try:
+                        key, slot, stored_at = line.split()
+                        slot, stored_at = int(slot), float(stored_at)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    if key in entries:
+                        keys_by_slot.pop(entries.pop(key)[0], None)
+                    if slot in keys_by_slot:
+                        del entries[keys_by_slot[slot]]
+                    entries[key] = (slot, stored_at)
+                    keys_by_slot[slot] = key
+                    self._logged += 1
+
+        now = time.time()
+        for key, (slot, stored_at) in entries.items():
+            if now - stored_at < self.ttl_seconds:
+                self._entries[key] = (slot, stored_at)
+        used = {slot for slot, _ in self._entries.values()}
+        self._free_slots = [slot for slot in range(self.max_entries - 1, -1, -1) if slot not in used]
+
+    def _save(self):
+        self._vectors.flush()
+        saved = {
+            "model_name": self.model_name,
+            "max_entries": self.max_entries,
+            "dim": self._dim,
+            "entries": [[key, slot, stored_at] for key, (slot, stored_at) in self._entries.items()],
+        }
+        tmp_path = self._index_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, self._index_path())
+        if self._log is not None:
+            self._log.close()
+        # Line buffered, so a store is on disk before its slot can be handed to another key
+        self._log = open(self._log_path(), "w", buffering=1)
+        self._logged = 0
+
+    def get(self, text):
+        key = self._key(normalize_query(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                slot, stored_at = entry
+                if time.time() - stored_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    metrics.count("embedding_cache.hit")
+                    return self._vectors[slot].tolist()
+                # Expired, give the slot back
+                del self._entries[key]
+                self._free_slots.append(slot)
+            self.misses += 1
+            metrics.count("embedding_cache.miss")
+            return None
+
+    def put(self, text, vector):
+        key = self._key(normalize_query(text))
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            if self._vectors is None:
+                self._allocate(vector.shape[0])
+
+            if key in self._entries:
+                slot, _ = self._entries.pop(key)
+            elif self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                _, (slot, _) = self._entries.popitem(last=False)
+                self.evictions += 1
+
+            self._vectors[slot] = vector
+            stored_at = time.time()
+            self._entries[key] = (slot, stored_at)
+            if self.path:
+                # A miss appends one line; the whole table is rewritten once the log is as long as it
+                if self._log is None or self._logged >= self.max_entries:
+                    self._save()
+                else:
+                    self._log.write(f"{key} {slot} {stored_at}\n")
+                    self._logged += 1
+
+    def get_or_compute(self, text, encode):
+        vector = self.get(text)
+        if vector is None:
+            vector = encode(normalize_query(text))
+            self.put(text, vector)
+            vector = np.asarray(vector, dtype=np.float32).tolist()
+        return vector
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
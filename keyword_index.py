@@ -0,0 +1,213 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from attributes import canonical_category, canonical_color, tokenize
+from rerank import STOPWORDS
+from retrieval import matches_filter
+
+
+def terms(text):
+    # Same canonical forms as the reranker, so "tees" finds "T-Shirt"; other
+    # tokens (brand names, model numbers) are kept as they are
+    return [
+        canonical_category(token) or canonical_color(token) or token
+        for token in tokenize(text)
+        if token not in STOPWORDS
+    ]
+
+
+def _hash(description, metadata):
+    return hashlib.sha1(json.dumps([description, metadata], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class KeywordIndex:
+    """BM25 inverted index over product descriptions, stored in SQLite.
+
+    pinecone_setup.py adds products incrementally; search() returns matches
+    shaped like RetrievalBackend.query() so they can be fused with the dense ones.
+    Searches score an in-memory copy of the postings, loaded on the first one
+    and again once another process has changed the file (checked every
+    refresh_seconds). With a filter, at most max_candidates of the best
+    matches are checked against it.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75, max_candidates=500, refresh_seconds=None):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_candidates = max_candidates
+        if refresh_seconds is None:
+            refresh_seconds = float(os.getenv("KEYWORD_INDEX_REFRESH", "30"))
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded = None
+        self._loaded_checked = 0.0
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER NOT NULL, hash TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._conn.commit()
+        self._load_stats()
+
+    def _load_stats(self):
+        count, total_length = self._conn.execute("SELECT count(*), coalesce(sum(length), 0) FROM docs").fetchone()
+        self.doc_count = count
+        self.avg_length = total_length / count if count else 0.0
+
+    def __len__(self):
+        return self.doc_count
+
+    def changed(self, ids, descriptions, metadatas):
+        """Positions of the products whose description or metadata differ from the indexed ones."""
+        known = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = [str(id) for id in ids[start:start + 500]]
+                known.update(self._conn.execute(
+                    f"SELECT id, hash FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+        return [
+            position for position, (id, description, metadata) in enumerate(zip(ids, descriptions, metadatas))
+            if known.get(str(id)) != _hash(description, metadata)
+        ]
+
+    def add(self, ids, descriptions, metadatas):
+        """Index products, replacing any earlier version of the same ids."""
+        with self._lock:
+            for id, description, metadata in zip(ids, descriptions, metadatas):
+                id = str(id)
+                counts = Counter(terms(description))
+                self._conn.execute("DELETE FROM postings WHERE id = ?", (id,))
+                self._conn.executemany(
+                    "INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                    [(term, id, tf) for term, tf in counts.items()]
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO docs (id, length, hash, metadata) VALUES (?, ?, ?, ?)",
+                    (id, sum(counts.values()), _hash(description, metadata), json.dumps(metadata))
+                )
+            self._conn.commit()
+            self._load_stats()
+            self._changed_here()
+
+    def delete(self, ids):
+        """Remove products, e.g. ones dropped from the catalog."""
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = [str(id) for id in ids[start:start + 500]]
+                placeholders = ",".join("?" * len(batch))
+                self._conn.execute(f"DELETE FROM postings WHERE id IN ({placeholders})", batch)
+                self._conn.execute(f"DELETE FROM docs WHERE id IN ({placeholders})", batch)
+            self._conn.commit()
+            self._load_stats()
+            self._changed_here()
+
+    def _changed_here(self):
+        # PRAGMA data_version only moves for other connections' commits
+        self._writes += 1
+        self._loaded_checked = float("-inf")
+
+    def _load(self, version):
+        conn = sqlite3.connect(self.path)
+        try:
+            docs = conn.execute("SELECT id, length, metadata FROM docs").fetchall()
+            rows_by_id = {id: row for row, (id, _, _) in enumerate(docs)}
+            grouped = {}
+            for term, id, tf in conn.execute("SELECT term, id, tf FROM postings"):
+                rows, tfs = grouped.setdefault(term, ([], []))
+                rows.append(rows_by_id[id])
+                tfs.append(tf)
+        finally:
+            conn.close()
+
+        lengths = np.array([length for _, length, _ in docs], dtype=np.float64)
+        avg_length = float(lengths.mean()) if len(docs) else 0.0
+        norms = self.k1 * (1 - self.b + self.b * lengths / max(avg_length, 1e-9))
+        postings = {}
+        for term, (rows, tfs) in grouped.items():
+            rows = np.array(rows, dtype=np.int64)
+            tfs = np.array(tfs, dtype=np.float64)
+            idf = math.log(1 + (len(docs) - len(rows) + 0.5) / (len(rows) + 0.5))
+            # Everything about a posting but the query is known up front, so a search only sums
+            postings[term] = (rows, idf * tfs * (self.k1 + 1) / (tfs + norms[rows]))
+        return {
+            "version": version,
+            "ids": [id for id, _, _ in docs],
+            "metadata": [metadata for _, _, metadata in docs],
+            "postings": postings,
+        }
+
+    def _searchable(self):
+        loaded = self._loaded
+        if loaded is not None and time.monotonic() - self._loaded_checked < self.refresh_seconds:
+            return loaded
+        # One thread reloads; the others keep searching the copy they have
+        if not self._load_lock.acquire(blocking=loaded is None):
+            return loaded
+        try:
+            self._loaded_checked = time.monotonic()
+            with self._lock:
+                version = (self._conn.execute("PRAGMA data_version").fetchone()[0], self._writes)
+            if self._loaded is None or self._loaded["version"] != version:
+                self._loaded = self._load(version)
+            return self._loaded
+        finally:
+            self._load_lock.release()
+
+    def search(self, text, top_k, filter=None):
+        query_terms = set(terms(text))
+        if not query_terms:
+            return []
+
+        searchable = self._searchable()
+        scores = np.zeros(len(searchable["ids"]))
+        for term in query_terms:
+            if term in searchable["postings"]:
+                rows, weights = searchable["postings"][term]
+                scores[rows] += weights
+        matched = int(np.count_nonzero(scores))
+        limit = min(self.max_candidates if filter else top_k, matched)
+        if not limit:
+            return []
+        candidates = np.argpartition(-scores, limit - 1)[:limit]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        matches = []
+        # Filtered-out products are skipped, so look at candidates in score order until top_k pass
+        for row in candidates.tolist():
+            metadata = json.loads(searchable["metadata"][row])
+            if filter and not matches_filter(metadata, filter):
+                continue
+            matches.append({"id": searchable["ids"][row], "score": float(scores[row]), "metadata": metadata})
+            if len(matches) == top_k:
+                break
+        return matches
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def reciprocal_rank_fusion(result_lists, top_k, k=60):
+    """Fuse ranked match lists by summing 1 / (k + rank), keeping the first metadata seen per id."""
+    fused = {}
+    for matches in result_lists:
+        for rank, match in enumerate(matches, start=1):
+            entry = fused.setdefault(match["id"], {"id": match["id"], "score": 0.0, "metadata": match["metadata"]})
+            entry["score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda match: match["score"], reverse=True)[:top_k]
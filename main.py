@@ -1,31 +1,63 @@
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
-from pinecone import Pinecone
+import asyncio
 import json
-from dotenv import load_dotenv
+import metrics
 import os
+import queue
+import re
+import time
+from attributes import query_filter
+from embedding_cache import normalize_query
+from keyword_index import reciprocal_rank_fusion
+import query_rewrite
+import rerank
+import resources
+import scheduler
 
 def configure():
-    load_dotenv()
+    resources.configure()
 
-conversation_history = []
 
-def build_suggestions_json(user_query, context):
-    # Call configure to load environment variables
-    configure()
-    
-    # Initialize the SentenceTransformer model
-    print("🚀 ~ context:", context)
-    model = SentenceTransformer('all-mpnet-base-v2')
-    
-    # Get API key from environment or provide a default for testing
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
-        raise ValueError("OpenAI API key is missing. Please set the OPENAI_API_KEY environment variable or add it to your .env file.")
-        
-    # Initialize the OpenAI client with the API key
-    client = OpenAI(api_key=openai_api_key)
-    
+# Define the function schema for structured output. Results name candidates by their
+# number in the prompt and are mapped back to the products locally (expand_suggestions),
+# so the model never has to echo URIs or descriptions.
+function_schema = {
+    "name": "suggestions",
+    "description": "Returns product suggestions",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "query": {"type": "string"},
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer", "description": "Candidate number"},
+                        "match_percentage": {"type": "number"}
+                    },
+                    "required": ["id", "match_percentage"]
+                }
+            },
+            "fallback_response": {
+                "type": "string",
+                "description": "A helpful, friendly reply when nothing matches: a greeting for greetings, an answer for general fashion questions"
+            }
+        },
+        "required": ["query", "results"]
+    }
+}
+
+# Kept byte-for-byte identical across calls, together with the schema and the
+# append-only history after it, so the provider can cache the prompt prefix
+system_prompt = """You are a shopping assistant matching a search query to numbered product candidates.
+Rules:
+1. Exact category: only products of the category searched for ("shoes" excludes flip-flops and sandals).
+2. Every key term of the query must appear in the description, colors exactly ("navy" is not "blue").
+3. At most 4 results with match_percentage >= 85, best first, each given by its candidate number.
+4. If nothing qualifies, return no results and a helpful fallback_response suited to the query.
+Example: "black formal shoes" matches "Men's Black Leather Oxford Formal Shoes", not "Black Casual Flip-flops" (category) or "Navy Blue Formal Shoes" (color)."""
+
+def build_query_messages(user_query, context):
     prompt_for_query = f"""
             Given the previous list of user queries and the current query, combine them to generate the exact query the user is making.
             The previous queries provide context to the current query. Ensure the generated query logically integrates the context and reflects the user's intent as accurately as possible.
@@ -39,166 +71,552 @@ def build_suggestions_json(user_query, context):
             Previous queries: ['I want tshirts', 'for boys', 'white color', 'shoes', 'black color']
             Current query: 'blue color'
             Generated exact query: "shoes with blue color"
-            ONLY return the exact query, no additional text or explanation. 
+            ONLY return the exact query, no additional text or explanation.
     """
-    try: 
-        # Create messages array with system message and conversation history
-        messages = [
-            {"role": "system", "content": "You are a helpful Assistant."}
-        ]
-        messages.append({"role": "user", "content": prompt_for_query})
-
-        # Call OpenAI API with conversation history
-        LLM_output_for_query = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages
-        )
-        structured_query = LLM_output_for_query.choices[0].message.content
+    # Create messages array with system message and conversation history
+    messages = [
+        {"role": "system", "content": "You are a helpful Assistant."}
+    ]
+    messages.append({"role": "user", "content": prompt_for_query})
+    return messages
+
+def encode_query(text):
+    # Concurrent queries share one encode call through the batcher
+    batcher = resources.get_embedding_batcher()
+    if batcher is not None:
+        return batcher.encode(text)
+    return resources.encode_batch([text])[0]
+
+def embed_query(structured_query):
+    # Embedding the user's query, repeated queries come straight from the cache
+    embedding_cache = resources.get_embedding_cache()
+    with metrics.span("embedding"):
+        query_embedding = embedding_cache.get_or_compute(structured_query, encode_query)
+    return query_embedding
+
+def retrieve_products(query_embedding, metadata_filter=None, query_text=None):
+    # Pinecone or the local index, depending on RETRIEVAL_BACKEND
+    backend = resources.get_retrieval_backend()
+    keyword_index = resources.get_keyword_index() if query_text else None
+
+    # Query the index for similar products. With the category/color/gender/price
+    # filter pushed into the search every candidate already fits, so fewer are needed.
+    matches = []
+    if metadata_filter:
+        top_k = int(os.getenv("RETRIEVAL_FILTERED_TOP_K", "6"))
+        with metrics.span("vector_query", filtered=True):
+            matches = backend.query(query_embedding, top_k=top_k, filter=metadata_filter)
+        metrics.count("retrieval.filtered")
+        if not matches:
+            metrics.count("retrieval.filter_unmatched")
+    if not matches:
+        # No filter, or nothing in the index carries matching metadata (e.g. it predates it)
+        metadata_filter = None
+        top_k = int(os.getenv("RETRIEVAL_TOP_K", "10"))
+        with metrics.span("vector_query"):
+            matches = backend.query(query_embedding, top_k=top_k)
+
+    # The dense cosine similarity is what's shown as a match percentage; after fusion
+    # "score" only orders the candidates
+    similarities = {match['id']: match['score'] for match in matches}
+    if keyword_index is not None:
+        # Exact terms (brand names, model numbers) that the dense vector misses come from
+        # BM25; both rankings are fused so the candidate budget stays the same
+        with metrics.span("keyword_query"):
+            keyword_matches = keyword_index.search(query_text, top_k, filter=metadata_filter)
+        matches = reciprocal_rank_fusion([matches, keyword_matches], top_k, k=int(os.getenv("RRF_K", "60")))
+
+    product_list = []
+    for match in matches:
+        product_data = {
+            "uri": match['metadata']['uri'],
+            "description": match['metadata']['description'],
+            "score": match['score'],
+            "similarity": similarities.get(match['id'], 0.0)
+        }
+        product_list.append(product_data)
+    return product_list
+
+def find_candidates(structured_query, query_embedding=None):
+    """Embed, retrieve and rerank locally: the CPU-bound part of the pipeline.
+
+    Returns (product_list, suggestions_json, index_version), suggestions_json
+    being None when the LLM has to rerank and index_version the snapshot
+    searched. Module-level so the worker service can run it in its process pool.
+    """
+    if query_embedding is None:
+        query_embedding = embed_query(structured_query)
+    product_list = retrieve_products(query_embedding, query_filter(structured_query), structured_query)
+    index_version = resources.get_retrieval_backend().version
+
+    # Clear-cut product queries are reranked on the CPU, the LLM only sees the rest
+    with metrics.span("rerank.local"):
+        suggestions_json = rerank.rerank_locally(structured_query, product_list)
+    return product_list, suggestions_json, index_version
+
+# Snapshot version the worker service's processes last searched
+_last_index_version = None
+
+def current_index_version():
+    """The snapshot version answers are coming from now, which responses are cached under.
+
+    After the index's alias moves, answers from the old version aren't served
+    or stored as answers for the new one.
+    """
+    if resources.get_cpu_executor() is not None:
+        return _last_index_version
+    return resources.get_retrieval_backend().version
+
+def cached_response_for(response_cache, structured_query):
+    """The cached response for structured_query, or None.
 
+    Reading the index version opens the index on first use; when that fails
+    the response cache is skipped and the search reports the outage.
+    """
+    try:
+        index_version = current_index_version()
     except Exception as e:
-        print(f"An error occurred while calling OpenAI for structured query: {e}")
-    # ------------------------------------------------------------------------------------------
+        print(f"Couldn't read the index version, skipping the response cache: {e}")
+        metrics.count("degraded.response_cache")
+        return None
+    return response_cache.get(structured_query, index_version)
+
+async def run_cpu_bound(function, *args):
+    # In the worker service this is its process pool, elsewhere a thread
+    executor = resources.get_cpu_executor()
+    if executor is None:
+        return await asyncio.to_thread(function, *args)
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+def estimate_tokens(message):
+    # About four characters per token for English text, plus per-message overhead
+    return len(message["content"] or "") // 4 + 4
 
-    # Embedding the user's query
-    query_embedding = model.encode(structured_query).tolist()
+def truncate_words(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "…"
 
-    # Initialize Pinecone client and index
-    pinecone_api_key = os.getenv("PINECONE_API_KEY")
-    pc = Pinecone(api_key=pinecone_api_key)
-    index = pc.Index("shopping-chatbot")
+def compact_candidates(product_list, max_tokens=None):
+    """Numbered candidate lines for the reranking prompt, and the products they stand for.
 
+    Duplicate descriptions are dropped and long ones truncated so the list fits
+    RERANK_CANDIDATE_TOKENS. candidates[n - 1] is the product numbered n.
+    """
+    if max_tokens is None:
+        max_tokens = int(os.getenv("RERANK_CANDIDATE_TOKENS", "600"))
+    seen = set()
+    unique = []
+    for product in product_list:
+        key = normalize_query(product["description"])
+        if key not in seen:
+            seen.add(key)
+            unique.append(product)
+    per_candidate_chars = max(max_tokens // max(len(unique), 1), 16) * 4
+
+    lines = []
+    candidates = []
+    used_tokens = 0
+    for product in unique:
+        line = f"{len(candidates) + 1}. {truncate_words(product['description'], per_candidate_chars)}"
+        line_tokens = len(line) // 4 + 1
+        if candidates and used_tokens + line_tokens > max_tokens:
+            break
+        lines.append(line)
+        candidates.append(product)
+        used_tokens += line_tokens
+    return "\n".join(lines), candidates
+
+def build_rerank_message(structured_query, product_list):
+    """The user message for this turn's reranking call, and the candidates it numbers."""
+    lines, candidates = compact_candidates(product_list)
+    return {"role": "user", "content": f"Search query: {structured_query}\nCandidates:\n{lines}"}, candidates
+
+def expand_result(item, candidates):
+    """A result naming a candidate number, in the full shape the app renders; None for an unknown number."""
     try:
-        # Query Pinecone index for similar products
-        response = index.query(
-            vector=query_embedding,
-            top_k=10,
-            include_values=True,
-            include_metadata=True
-        )
+        product = candidates[int(item["id"]) - 1] if int(item["id"]) >= 1 else None
+    except (KeyError, ValueError, TypeError, IndexError):
+        product = None
+    if product is None:
+        return None
+    return {
+        "match": product["description"],
+        "match_percentage": item.get("match_percentage"),
+        "product_url": product["uri"],
+        "product_description": product["description"]
+    }
 
-        product_list = []
-        product_descriptions = []  # Store product descriptions to send in one OpenAI request
- 
-        for match in response['matches']:
-            pdt_desc = match['metadata']['description']
-            uri = match['metadata']['uri']
+def expand_suggestions(compact, candidates):
+    results = [expand_result(item, candidates) for item in compact.get("results") or []]
+    return {**compact, "results": [result for result in results if result is not None]}
 
-            product_descriptions.append(pdt_desc)  # Append product descriptions to the list
+def remember_turn(history, structured_query, suggestions_json):
+    # Only the query and what was picked go into the history, not the candidate lists:
+    # they are large and their numbers mean nothing in later turns
+    add_to_history(history, {"role": "user", "content": f"Search query: {structured_query}"})
+    picked = [truncate_words(result["product_description"], 80) for result in suggestions_json.get("results") or []]
+    reply = {"picked": picked}
+    if suggestions_json.get("fallback_response"):
+        reply["fallback_response"] = suggestions_json["fallback_response"]
+    add_to_history(history, {"role": "assistant", "content": json.dumps(reply)})
 
-            product_data = {
-                "uri": uri,
-                "description": pdt_desc
-            }
+def add_to_history(history, message, max_tokens=None):
+    """Append message to a session's reranking history, dropping the oldest turns past the token budget."""
+    if max_tokens is None:
+        max_tokens = int(os.getenv("RERANK_HISTORY_TOKENS", "3000"))
+    history.append(message)
+    while len(history) > 1 and sum(estimate_tokens(m) for m in history) > max_tokens:
+        # Drop a whole user/assistant turn so the history keeps alternating
+        del history[:2 if len(history) > 2 else 1]
 
-            product_list.append(product_data)
-
-        # Define the function schema for structured output 
-        function_schema = {
-            "name": "suggestions",
-            "description": "Returns product suggestions",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {"type": "string"},
-                    "results": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "match": {"type": "string"},
-                                "match_percentage": {"type": "number"},
-                                "product_url": {"type": "string"},
-                                "product_description": {"type": "string"}
-                            },
-                            "required": ["match", "match_percentage", "product_url", "product_description"]
-                        }
-                    },
-                    "fallback_response": {
-                        "type": "string",
-                        "description": "A helpful and frindly response suitable for user query to the user, If query is greeting, return a greeting response, If user asks any general fashion related query, return a response based on the context"
-                    }
-                },
-                "required": ["query", "results"]
-            }
-        }
+def build_suggestions_json(user_query, context, history=None):
+    start = time.perf_counter()
+    try:
+        with metrics.span("pipeline"), metrics.profiled("build_suggestions_json"):
+            return _build_suggestions_json(user_query, context, [] if history is None else history)
+    finally:
+        resources.record_query_time(time.perf_counter() - start)
+
+UNAVAILABLE_MESSAGE = "Sorry, I can't search the catalog right now. Please try again in a moment."
+
+def unavailable_response(structured_query):
+    # Product search itself failed: answer with a message rather than an error
+    return {"query": structured_query, "results": [], "fallback_response": UNAVAILABLE_MESSAGE}
 
-        
+def _build_suggestions_json(user_query, context, conversation_history):
+    # Shared client, loaded once per process
+    print("🚀 ~ context:", context)
+    client = resources.get_openai_client()
+
+    # Only ask the LLM to merge the context in when it could change the query
+    structured_query = query_rewrite.local_rewrite(user_query, context)
+    if structured_query is None:
         try:
-            system_prompt = f"""
-            You are a specialized shopping assistant that accurately matches user search queries to product listings.
-
-            Your primary goal is to return only the most relevant products that precisely match the user's search intent. You must follow these strict matching rules:
-
-            1. EXACT CATEGORY MATCHING: Only include products that belong to the exact category the user is searching for (e.g., "shoes" should not return flip-flops or sandals).
-
-            2. KEYWORD PRECISION: All key terms in the user's query must appear in the product description. Missing any essential keyword disqualifies the product.
-
-            3. RELEVANCE FILTERING: Return a maximum of 4 products with at least 85% match relevance, sorted in descending order of match percentage.
-
-            4. CLEAN OUTPUT: Respond with a valid JSON object containing:
-               - The query
-               - Matched results array
-               - A fallback_response when no matches are found, provide a helpful fallback_response suitable for user query to user.
-
-            Example Correct Matches:
-            Query: "black formal shoes"
-            ✓ "Men's Black Leather Oxford Formal Shoes"
-            ✗ "Black Casual Flip-flops" (wrong category)
-            ✗ "Navy Blue Formal Shoes" (wrong color)
-            
-            Query: "blue formal shirts"
-            ✓ "Men's Blue Cotton Formal Shirt"
-            ✗ "Blue Cotton T-shirt" (wrong category)
-            ✗ "Navy Formal Shirt" (not exact color match)
-
-            If no products meet the criteria, provide a helpful fallback_response suitable for user query to user.
-            """
-            
-            # Create user message with product matching prompt
-            user_message = {
-                "role": "user", 
-                "content": f"""
-                Read this current user search query: '{structured_query}'
-                Compare it against the following product records: {product_list}  
-                """
-            }
-            
-            # messages.append(user_message)
-            conversation_history.append(user_message)  # Add user message to history
+            # Call OpenAI API with conversation history
+            with metrics.span("query_rewrite"):
+                LLM_output_for_query = scheduler.call(
+                    "openai", "query_rewrite", client.chat.completions.create,
+                    timeout_argument="timeout",
+                    model="gpt-4o-mini",
+                    messages=build_query_messages(user_query, context)
+                )
+            metrics.record_tokens("query_rewrite", LLM_output_for_query.usage)
+            structured_query = LLM_output_for_query.choices[0].message.content
+            query_rewrite.remember_rewrite(user_query, context, structured_query)
+
+        except Exception as e:
+            # Search with what the user typed rather than wait or fail
+            print(f"An error occurred while calling OpenAI for structured query: {e}")
+            metrics.count("degraded.query_rewrite")
+            structured_query = user_query
+    # ------------------------------------------------------------------------------------------
+
+    # A repeated query against the same catalog gets the same answer
+    response_cache = resources.get_response_cache()
+    cached_response = cached_response_for(response_cache, structured_query)
+    if cached_response is not None:
+        return cached_response
+
+    try:
+        product_list, suggestions_json, index_version = find_candidates(structured_query)
+    except Exception as e:
+        print(f"An error occurred while searching for products: {e}")
+        metrics.count("degraded.retrieval")
+        return unavailable_response(structured_query)
+    if suggestions_json is not None:
+        print("🚀 ~ suggestions_json (local rerank):", suggestions_json)
+        response_cache.put(structured_query, suggestions_json, index_version)
+        return suggestions_json
 
-            # Call OpenAI API with the conversation history
-            LLM_output = client.chat.completions.create(
+    try:
+        user_message, candidates = build_rerank_message(structured_query, product_list)
+
+        # Call OpenAI API with this session's history and the current candidates last
+        with metrics.span("rerank.llm"):
+            LLM_output = scheduler.call(
+                "openai", "rerank", client.chat.completions.create,
+                timeout_argument="timeout",
                 model="gpt-4o-mini",
                 messages=[
-                    {"role": "system", 
+                    {"role": "system",
                      "content": system_prompt}
-                ] + conversation_history,
+                ] + conversation_history + [user_message],
                 functions=[function_schema]
             )
+        metrics.record_tokens("rerank", LLM_output.usage)
 
-            try:
-                LLM_response = LLM_output.choices[0].message.function_call.arguments
-            except:
-                LLM_response = LLM_output.choices[0].message.content
-
-            # Add assistant's response to conversation history
-            assistant_message = {
-                "role": "assistant",
-                "content": LLM_response
-            }
-            conversation_history.append(assistant_message)
-            suggestions_json = json.loads(LLM_response)
-            print("🚀 ~ suggestions_json:", suggestions_json)
-            return suggestions_json
+        try:
+            LLM_response = LLM_output.choices[0].message.function_call.arguments
+        except:
+            LLM_response = LLM_output.choices[0].message.content
 
-        except Exception as e:
-            print(f"An error occurred while calling OpenAI: {e}")
-        
-        print("#"*100,"\n")
+        with metrics.span("json_parse"):
+            suggestions_json = expand_suggestions(json.loads(LLM_response), candidates)
+        # Add this turn to the conversation history
+        remember_turn(conversation_history, structured_query, suggestions_json)
+        print("🚀 ~ suggestions_json:", suggestions_json)
+        response_cache.put(structured_query, suggestions_json, index_version)
         return suggestions_json
 
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        # Retrieval order instead of the LLM's; not cached, so the next ask gets a real rerank
+        print(f"An error occurred while calling OpenAI: {e}")
+        metrics.count("degraded.rerank")
+        suggestions_json = rerank.vector_ranked(structured_query, product_list)
+
+    print("#"*100,"\n")
+    return suggestions_json
+
+# ------------------------------------------------------------------------------------------
+# Streaming pipeline
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def partial_json_string(buffer, key):
+    """Decoded prefix of the string value of key in a JSON object that is still being streamed."""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), buffer)
+    if not match:
+        return None
+    text = []
+    i = match.end()
+    while i < len(buffer):
+        char = buffer[i]
+        if char == '"':
+            break
+        if char == '\\':
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape == 'u':
+                if i + 6 > len(buffer):
+                    break
+                code = int(buffer[i + 2:i + 6], 16)
+                if 0xD800 <= code < 0xDC00:
+                    # High half of a surrogate pair (emoji): wait for the low half and combine them
+                    if i + 12 > len(buffer) and '\\u'.startswith(buffer[i + 6:i + 8]):
+                        break
+                    low = int(buffer[i + 8:i + 12], 16) if buffer[i + 6:i + 8] == '\\u' else None
+                    if low is not None and 0xDC00 <= low < 0xE000:
+                        text.append(chr(0x10000 + (code - 0xD800) * 0x400 + low - 0xDC00))
+                        i += 12
+                        continue
+                    code = 0xFFFD
+                elif 0xDC00 <= code < 0xE000:
+                    code = 0xFFFD
+                text.append(chr(code))
+                i += 6
+                continue
+            text.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        text.append(char)
+        i += 1
+    return "".join(text)
+
+def partial_json_array_items(buffer, key):
+    """Objects of the array value of key that have been streamed completely so far."""
+    match = re.search(r'"%s"\s*:\s*\[' % re.escape(key), buffer)
+    if not match:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    i = match.end()
+    while True:
+        while i < len(buffer) and buffer[i] in " \t\r\n,":
+            i += 1
+        if i >= len(buffer) or buffer[i] == ']':
+            return items
+        try:
+            item, i = decoder.raw_decode(buffer, i)
+        except ValueError:
+            return items
+        items.append(item)
+
+async def stream_suggestions(user_query, context, conversation_history):
+    """Async version of build_suggestions_json that yields output as soon as it is available.
+
+    Yields ("result", item) for each product suggestion, ("text", delta) for
+    the fallback response text, and finally ("done", suggestions_json).
+    """
+    global _last_index_version
+    start = time.perf_counter()
+    print("🚀 ~ context:", context)
+    client = resources.get_async_openai_client()
+
+    # Load the model and open the index while the rewrite call is in flight
+    # (the worker service's processes load them when they start). A failure
+    # shows up again when the search needs them and is handled there
+    warm_up = asyncio.gather(
+        asyncio.to_thread(resources.get_model),
+        asyncio.to_thread(resources.get_retrieval_backend),
+        return_exceptions=True
+    ) if resources.get_cpu_executor() is None else asyncio.sleep(0)
+    try:
+        structured_query = query_rewrite.local_rewrite(user_query, context)
+        if structured_query is None:
+            with metrics.span("query_rewrite"):
+                LLM_output_for_query = await scheduler.acall(
+                    "openai", "query_rewrite", client.chat.completions.create,
+                    timeout_argument="timeout",
+                    model="gpt-4o-mini",
+                    messages=build_query_messages(user_query, context)
+                )
+            metrics.record_tokens("query_rewrite", LLM_output_for_query.usage)
+            structured_query = LLM_output_for_query.choices[0].message.content
+            query_rewrite.remember_rewrite(user_query, context, structured_query)
+    except Exception as e:
+        # Search with what the user typed rather than wait or fail
+        print(f"An error occurred while calling OpenAI for structured query: {e}")
+        metrics.count("degraded.query_rewrite")
+        structured_query = user_query
+    finally:
+        await warm_up
+
+    response_cache = resources.get_response_cache()
+    cached_response = await asyncio.to_thread(cached_response_for, response_cache, structured_query)
+    if cached_response is not None:
+        for item in cached_response.get("results") or []:
+            yield ("result", item)
+        if cached_response.get("fallback_response"):
+            yield ("text", cached_response["fallback_response"])
+        metrics.observe("pipeline", time.perf_counter() - start)
+        resources.record_query_time(time.perf_counter() - start)
+        yield ("done", cached_response)
+        return
+
+    # Embedded here rather than in find_candidates so concurrent sessions' queries are
+    # batched together (in the worker service too, whose batches go to its process pool)
+    try:
+        query_embedding = await asyncio.to_thread(embed_query, structured_query)
+        product_list, suggestions_json, index_version = await run_cpu_bound(
+            find_candidates, structured_query, query_embedding
+        )
+    except Exception as e:
+        print(f"An error occurred while searching for products: {e}")
+        metrics.count("degraded.retrieval")
+        suggestions_json = unavailable_response(structured_query)
+        yield ("text", suggestions_json["fallback_response"])
+        resources.record_query_time(time.perf_counter() - start)
+        yield ("done", suggestions_json)
+        return
+    _last_index_version = index_version
+    if suggestions_json is not None:
+        print("🚀 ~ suggestions_json (local rerank):", suggestions_json)
+        response_cache.put(structured_query, suggestions_json, index_version)
+        for item in suggestions_json["results"]:
+            yield ("result", item)
+        metrics.observe("pipeline", time.perf_counter() - start)
+        resources.record_query_time(time.perf_counter() - start)
+        yield ("done", suggestions_json)
+        return
+
+    user_message, candidates = build_rerank_message(structured_query, product_list)
+    rerank_start = time.perf_counter()
+    # One deadline for the whole rerank: opening the stream and reading it to the end
+    deadline = scheduler.stage_deadline("rerank")
+    arguments = ""
+    content = ""
+    streamed_text = ""
+    streamed_results = 0
+    stream = None
+    try:
+        stream = await scheduler.acall(
+            "openai", "rerank", client.chat.completions.create,
+            timeout_argument="timeout",
+            timeout=deadline - time.monotonic(),
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system",
+                 "content": system_prompt}
+            ] + conversation_history + [user_message],
+            functions=[function_schema],
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        async for chunk in scheduler.iterate_until(stream, deadline, "rerank"):
+            if not chunk.choices:
+                # The last chunk carries only the token usage
+                metrics.record_tokens("rerank", chunk.usage)
+                continue
+            if not arguments and not content:
+                metrics.observe("rerank.llm_first_token", time.perf_counter() - rerank_start)
+            delta = chunk.choices[0].delta
+            if delta.function_call and delta.function_call.arguments:
+                arguments += delta.function_call.arguments
+            elif delta.content:
+                content += delta.content
+            else:
+                continue
+
+            buffer = arguments or content
+            results = partial_json_array_items(buffer, "results")
+            for item in results[streamed_results:]:
+                result = expand_result(item, candidates)
+                if result is not None:
+                    yield ("result", result)
+            streamed_results = len(results)
+
+            text = partial_json_string(buffer, "fallback_response")
+            if text and len(text) > len(streamed_text):
+                yield ("text", text[len(streamed_text):])
+                streamed_text = text
+
+        metrics.observe("rerank.llm", time.perf_counter() - rerank_start)
+        LLM_response = arguments or content
+        with metrics.span("json_parse"):
+            suggestions_json = expand_suggestions(json.loads(LLM_response), candidates)
+    except Exception as e:
+        # Keep whatever was already shown; with nothing shown yet, fall back to retrieval
+        # order. Not cached or remembered, so the next ask gets a real rerank.
+        print(f"An error occurred while calling OpenAI: {e}")
+        metrics.count("degraded.rerank")
+        if hasattr(stream, "close"):
+            # Stop reading a stream that ran past its deadline and free the connection
+            await stream.close()
+        buffer = arguments or content
+        if streamed_results:
+            results = [expand_result(item, candidates) for item in partial_json_array_items(buffer, "results")]
+            suggestions_json = {"query": structured_query, "results": [result for result in results if result]}
+        elif streamed_text:
+            suggestions_json = {"query": structured_query, "results": [], "fallback_response": streamed_text}
+        else:
+            suggestions_json = rerank.vector_ranked(structured_query, product_list)
+            for item in suggestions_json["results"]:
+                yield ("result", item)
+        metrics.observe("pipeline", time.perf_counter() - start)
+        resources.record_query_time(time.perf_counter() - start)
+        yield ("done", suggestions_json)
+        return
+
+    remember_turn(conversation_history, structured_query, suggestions_json)
+    print("🚀 ~ suggestions_json:", suggestions_json)
+    response_cache.put(structured_query, suggestions_json, index_version)
+    metrics.observe("pipeline", time.perf_counter() - start)
+    resources.record_query_time(time.perf_counter() - start)
+    yield ("done", suggestions_json)
+
+def stream_suggestions_sync(user_query, context, conversation_history):
+    """Run stream_suggestions on the shared event loop and yield its events to a synchronous caller."""
+    events = queue.Queue()
+
+    async def pump():
+        try:
+            async for event in stream_suggestions(user_query, context, conversation_history):
+                events.put(event)
+        except Exception as e:
+            print(f"An error occurred while streaming suggestions: {e}")
+            events.put(("error", e))
+        finally:
+            events.put(None)
+
+    asyncio.run_coroutine_threadsafe(pump(), resources.get_event_loop())
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        yield event
 
 # user_q = "Give me yellow footwear"
 # print(build_suggestions_json(user_q))
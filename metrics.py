@@ -0,0 +1,209 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Timing spans and token counts for the suggestion pipeline, the DB helpers and
+# Streamlit rendering. Each span name keeps totals plus a window of recent
+# durations for percentiles; every observation can also go to a JSONL file.
+_lock = threading.Lock()
+_spans = {}
+_tokens = {}
+_counters = {}
+_jsonl_file = None
+_server = None
+
+RECENT_SAMPLES = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _jsonl():
+    global _jsonl_file
+    path = os.getenv("METRICS_JSONL_PATH")
+    if path and _jsonl_file is None:
+        _jsonl_file = open(path, "a", buffering=1)
+    return _jsonl_file
+
+
+def _write_event(event):
+    jsonl = _jsonl()
+    if jsonl:
+        with _lock:
+            jsonl.write(json.dumps(event) + "\n")
+
+
+def observe(name, seconds, error=False, **labels):
+    with _lock:
+        span = _spans.setdefault(name, {"count": 0, "errors": 0, "sum": 0.0, "max": 0.0, "recent": deque(maxlen=RECENT_SAMPLES)})
+        span["count"] += 1
+        span["errors"] += int(error)
+        span["sum"] += seconds
+        span["max"] = max(span["max"], seconds)
+        span["recent"].append(seconds)
+    _write_event({"ts": time.time(), "span": name, "seconds": round(seconds, 6), "error": error, **labels})
+
+
+@contextmanager
+def span(name, **labels):
+    """Time the enclosed block under name; errors are counted and re-raised."""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        # Streamlit's rerun/stop signals derive from BaseException and aren't errors
+        error = True
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, error=error, **labels)
+
+
+def count(name, value=1):
+    """Add value to the counter name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def record_tokens(stage, usage):
+    """Add the prompt/completion token counts of an OpenAI response's usage to stage."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    with _lock:
+        tokens = _tokens.setdefault(stage, {"prompt": 0, "completion": 0, "calls": 0})
+        tokens["prompt"] += prompt_tokens
+        tokens["completion"] += completion_tokens
+        tokens["calls"] += 1
+    _write_event({"ts": time.time(), "tokens": stage, "prompt": prompt_tokens, "completion": completion_tokens})
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summary(prefix=""):
+    with _lock:
+        spans = {name: dict(span, recent=sorted(span["recent"])) for name, span in _spans.items() if name.startswith(prefix)}
+    return {
+        name: {
+            "count": span["count"],
+            "errors": span["errors"],
+            "avg_seconds": span["sum"] / span["count"],
+            "max_seconds": span["max"],
+            **{f"p{int(q * 100)}_seconds": _quantile(span["recent"], q) for q in QUANTILES},
+        }
+        for name, span in spans.items()
+    }
+
+
+def token_summary():
+    with _lock:
+        return {stage: dict(tokens) for stage, tokens in _tokens.items()}
+
+
+def prometheus_text():
+    """All spans and token counters in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE shopping_span_seconds summary",
+    ]
+    with _lock:
+        spans = {name: dict(span, recent=sorted(span["recent"])) for name, span in _spans.items()}
+        tokens = {stage: dict(values) for stage, values in _tokens.items()}
+        counter_values = dict(_counters)
+    for name, span in sorted(spans.items()):
+        for q in QUANTILES:
+            lines.append(f'shopping_span_seconds{{span="{name}",quantile="{q}"}} {_quantile(span["recent"], q):.6f}')
+        lines.append(f'shopping_span_seconds_sum{{span="{name}"}} {span["sum"]:.6f}')
+        lines.append(f'shopping_span_seconds_count{{span="{name}"}} {span["count"]}')
+    lines.append("# TYPE shopping_span_errors_total counter")
+    for name, span in sorted(spans.items()):
+        lines.append(f'shopping_span_errors_total{{span="{name}"}} {span["errors"]}')
+    lines.append("# TYPE shopping_llm_tokens_total counter")
+    for stage, values in sorted(tokens.items()):
+        lines.append(f'shopping_llm_tokens_total{{stage="{stage}",kind="prompt"}} {values["prompt"]}')
+        lines.append(f'shopping_llm_tokens_total{{stage="{stage}",kind="completion"}} {values["completion"]}')
+    lines.append("# TYPE shopping_events_total counter")
+    for name, value in sorted(counter_values.items()):
+        lines.append(f'shopping_events_total{{name="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server():
+    """Serve /metrics on METRICS_PORT, if set. Safe to call more than once."""
+    global _server
+    port = os.getenv("METRICS_PORT")
+    if not port or _server is not None:
+        return _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            print(f"Serving metrics on :{port}/metrics")
+    return _server
+
+
+@contextmanager
+def profiled(name):
+    """Profile a PROFILE_SAMPLE_RATE fraction of calls and write the report to PROFILE_DIR.
+
+    Uses pyinstrument's sampling profiler when it is installed, cProfile otherwise.
+    """
+    rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    if rate <= 0 or random.random() >= rate:
+        yield
+        return
+
+    directory = os.getenv("PROFILE_DIR", "profiles")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{random.randrange(1 << 16):04x}")
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path + ".html", "w") as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
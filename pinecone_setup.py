@@ -1,17 +1,47 @@
-from pinecone import Pinecone
-import psycopg2
-from sentence_transformers import SentenceTransformer
+import hashlib
+import json
 import os
-from dotenv import load_dotenv
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+import resources
+import snapshot
+from attributes import extract_metadata
+from keyword_index import KeywordIndex
+from response_cache import bump_catalog_version
+from embedding import check_compatible, manifest
+from retrieval import CATALOG_NAMESPACES, LocalBackend, LocalIndexWriter, read_pinecone_manifest, write_pinecone_manifest
 
-# model = SentenceTransformer('all-MiniLM-L6-v2')
-model = SentenceTransformer('all-mpnet-base-v2')
+resources.configure()
 
 database = "shopping_chatbot"
 user = "postgres"
 password = ""
 host = "localhost"
 
+# Rows pulled from the server-side cursor per round trip
+FETCH_SIZE = int(os.getenv("INGEST_FETCH_SIZE", "1000"))
+# Descriptions per model.encode call
+ENCODE_BATCH_SIZE = int(os.getenv("INGEST_ENCODE_BATCH_SIZE", "64"))
+# Vectors per Pinecone upsert request, and how many requests run at once
+UPSERT_BATCH_SIZE = int(os.getenv("INGEST_UPSERT_BATCH_SIZE", "100"))
+UPSERT_WORKERS = int(os.getenv("INGEST_UPSERT_WORKERS", "4"))
+# The resume checkpoint lives here
+STATE_PATH = os.getenv("INGEST_STATE_PATH", "ingest_state.sqlite")
+# BM25 index over pdt_desc, updated alongside the vectors when set
+KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH")
+# Optional apparels column holding the price, stored as a price band in the metadata
+PRICE_COLUMN = os.getenv("INGEST_PRICE_COLUMN")
+# Snapshot versions kept on disk besides the ones the index's namespaces hold
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+# How long a published namespace may take to show all its vectors before the alias switch is abandoned
+PUBLISH_READY_TIMEOUT = float(os.getenv("PUBLISH_READY_TIMEOUT", "300"))
+
+
 def connect_db(dbname):
     try:
         conn = psycopg2.connect(
@@ -25,53 +55,301 @@ def connect_db(dbname):
         print(f"Error connecting to Database {dbname}: ", e)
 
 
-conn = connect_db(database)
-cursor = conn.cursor()
+def chunk_list(data, chunk_size):
+    """Split data into chunks of a specified size."""
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
 
-cursor.execute("""
-    SELECT id, pdt_desc, uri FROM apparels
-""")
-embeddings = cursor.fetchall()
 
-# print(embeddings[1])
+def product_metadata(row):
+    # row is (id, pdt_desc, uri) or (id, pdt_desc, uri, price)
+    price = row[3] if len(row) > 3 else None
+    return {"description": row[1], "uri": row[2], **extract_metadata(row[1], price)}
 
-vectors = []
 
-i=0
-for vector in embeddings:
-    id, description, uri = vector
+def metadata_hash(metadata):
+    # Hashing the metadata too re-embeds a row whose extracted attributes change
+    return hashlib.sha1(json.dumps(metadata, sort_keys=True).encode("utf-8")).hexdigest()
 
-    vectors.append({
-        "id" : str(id),
-        "values" : model.encode(description).tolist(),
-        "metadata" : {
-            "description" : description,
-            "uri" : uri
-        }
-    })
-    i += 1
-    print("done : " , i)
 
-print("completed with the vector conversions")
+def open_state(path):
+    state = sqlite3.connect(path)
+    state.execute("CREATE TABLE IF NOT EXISTS checkpoint (name TEXT PRIMARY KEY, value TEXT)")
+    state.commit()
+    return state
 
-# Get Pinecone API key from environment variable
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
-if not pinecone_api_key:
-    raise ValueError("Pinecone API key is not set in environment variables")
 
-pc = Pinecone(api_key=pinecone_api_key)
-index = pc.Index("shopping-chatbot")
+def read_checkpoint(state):
+    values = dict(state.execute("SELECT name, value FROM checkpoint").fetchall())
+    if "last_id" not in values or "snapshot_rows" not in values:
+        # Nothing to resume, or a run from before snapshots: start from the top
+        return None, None, None, 0
+    local_resume = None
+    if "local_rows" in values:
+        local_dim = int(values["local_dim"]) if "local_dim" in values else None
+        local_resume = (int(values["local_rows"]), local_dim)
+    return int(values["last_id"]), local_resume, int(values["snapshot_rows"]), int(values.get("embedded", 0))
 
-def chunk_list(data, chunk_size):
-    """Split data into chunks of a specified size."""
-    for i in range(0, len(data), chunk_size):
-        yield data[i:i + chunk_size]
 
-chunk_size = 100  # Adjust this size based on the vector length and the payload size
-for batch in chunk_list(vectors, chunk_size):
-    # Send each batch to Pinecone
-    index.upsert(vectors=batch)
+def write_checkpoint(state, checkpoint):
+    # Written once a chunk is on disk in the snapshot, so a resumed run never skips rows
+    state.executemany(
+        "INSERT OR REPLACE INTO checkpoint (name, value) VALUES (?, ?)",
+        [(name, str(value)) for name, value in checkpoint.items() if value is not None]
+    )
+    state.commit()
+
+
+def encode_rows(model, rows):
+    vectors = []
+    for batch in chunk_list(rows, ENCODE_BATCH_SIZE):
+        embeddings = model.encode([row[1] for row in batch], batch_size=ENCODE_BATCH_SIZE)
+        for row, embedding in zip(batch, embeddings):
+            vectors.append({
+                "id": str(row[0]),
+                "values": embedding.tolist(),
+                "metadata": product_metadata(row)
+            })
+    return vectors
+
+
+def update_keyword_index(keyword_index, rows):
+    metadatas = [product_metadata(row) for row in rows]
+    changed = keyword_index.changed([row[0] for row in rows], [row[1] for row in rows], metadatas)
+    if changed:
+        keyword_index.add(
+            [rows[i][0] for i in changed],
+            [rows[i][1] for i in changed],
+            [metadatas[i] for i in changed]
+        )
+
+
+def compatible(embedding_a, embedding_b):
+    return (embedding_a["model"], embedding_a.get("truncate_dim")) == (embedding_b["model"], embedding_b.get("truncate_dim"))
+
+
+def upsert_rows(index, catalog, rows, namespace):
+    index.upsert(
+        vectors=[
+            {"id": str(catalog.ids[row]), "values": catalog.vector(row).tolist(), "metadata": catalog.metadata(row)}
+            for row in rows
+        ],
+        namespace=namespace
+    )
+
+
+def namespace_count(index, namespace):
+    stats = index.describe_index_stats()
+    namespaces = stats["namespaces"] if isinstance(stats, dict) else stats.namespaces
+    if namespace not in namespaces:
+        return 0
+    counts = namespaces[namespace]
+    return counts["vector_count"] if isinstance(counts, dict) else counts.vector_count
+
+
+def switch_alias(index, alias, namespace):
+    # The top-level fields describe the namespace queries go to
+    manifest = dict(alias["namespaces"][namespace], namespace=namespace, namespaces=alias["namespaces"])
+    write_pinecone_manifest(index, manifest)
+    print(f"Index alias now points at {namespace} (snapshot {manifest['version']})")
+
+
+def publish(index, catalog, full=False):
+    """Upload a snapshot to the namespace queries aren't using, then switch the alias to it.
+
+    The namespace is brought from the snapshot it held before to this one:
+    only products whose hash changed are upserted and removed ones deleted.
+    With full, or without that older snapshot on disk, it is rewritten whole.
+    """
+    alias = read_pinecone_manifest(index) or {}
+    namespaces = alias.get("namespaces", {})
+    target = CATALOG_NAMESPACES[1] if alias.get("namespace") == CATALOG_NAMESPACES[0] else CATALOG_NAMESPACES[0]
+
+    base = None
+    if not full and target in namespaces:
+        base = snapshot.load(namespaces[target]["version"])
+        if base is not None and not compatible(base.embedding_manifest, catalog.embedding_manifest):
+            base = None
+
+    if base is None:
+        rows = list(range(len(catalog)))
+        deleted = []
+        if namespace_count(index, target):
+            index.delete(delete_all=True, namespace=target)
+        print(f"Uploading all {len(rows)} products of snapshot {catalog.version} to {target}")
+    else:
+        rows = [row for row in range(len(catalog)) if base.hash_of(catalog.ids[row]) != catalog.hashes[row]]
+        deleted = [id for id in base.ids.tolist() if catalog.row_of(id) is None]
+        print(f"Updating {target} from snapshot {base.version} to {catalog.version}: "
+              f"{len(rows)} products changed, {len(deleted)} removed")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as executor:
+        futures = [executor.submit(upsert_rows, index, catalog, batch, target) for batch in chunk_list(rows, UPSERT_BATCH_SIZE)]
+        futures += [executor.submit(index.delete, ids=batch, namespace=target) for batch in chunk_list(deleted, 1000)]
+        for future in futures:
+            future.result()
+
+    # Writes become visible to queries with a delay; don't switch before they have
+    deadline = time.monotonic() + PUBLISH_READY_TIMEOUT
+    while namespace_count(index, target) != len(catalog):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{target} didn't reach {len(catalog)} vectors in {PUBLISH_READY_TIMEOUT:.0f}s, alias left as it was")
+        time.sleep(2)
+    print(f"{target} ready in {time.perf_counter() - start:.1f}s")
+
+    namespaces = dict(namespaces, **{target: dict(catalog.embedding_manifest, version=catalog.version)})
+    switch_alias(index, {"namespaces": namespaces}, target)
+    return namespaces
+
+
+def rollback(index):
+    """Point the alias back at the other namespace, which still holds the previous version."""
+    alias = read_pinecone_manifest(index)
+    other = CATALOG_NAMESPACES[1] if (alias or {}).get("namespace") == CATALOG_NAMESPACES[0] else CATALOG_NAMESPACES[0]
+    if not alias or other not in alias.get("namespaces", {}):
+        raise ValueError("The index has no previous catalog version to roll back to")
+    switch_alias(index, alias, other)
+    # Answers cached from the version rolled back from mustn't be served
+    bump_catalog_version()
+
+
+def ingest(full=False):
+    pinecone_api_key = os.getenv("PINECONE_API_KEY")
+    if not pinecone_api_key:
+        raise ValueError("Pinecone API key is not set in environment variables")
+
+    model = resources.get_model()
+    index = resources.get_pinecone_index()
+    local_index_dir = os.getenv("LOCAL_INDEX_DIR")
+    embedding_manifest = manifest(resources.embedding_config(), model.get_sentence_embedding_dimension())
+
+    # Unchanged products keep their vectors from the latest snapshot instead of being re-embedded
+    previous = None if full else snapshot.load()
+    if previous is not None:
+        check_compatible(previous.embedding_manifest, resources.embedding_config(), f"Snapshot {previous.version}")
+    local_index_exists = bool(local_index_dir) and os.path.exists(os.path.join(local_index_dir, "vectors.npy"))
+    if not full and local_index_exists:
+        check_compatible(LocalBackend(local_index_dir).manifest, resources.embedding_config(), "The local index")
+    # Without a local index to carry unchanged products over from, it gets every row
+    local_gets_all_rows = full or not local_index_exists
+
+    state = open_state(STATE_PATH)
+    if full:
+        state.execute("DELETE FROM checkpoint")
+        state.commit()
+
+    last_id, local_resume, snapshot_rows, resumed_embedded = read_checkpoint(state)
+    if last_id is not None:
+        print(f"Resuming ingestion after id {last_id}")
+
+    snapshot_writer = snapshot.SnapshotWriter(embedding_manifest, resume=snapshot_rows)
+    local_writer = LocalIndexWriter(
+        local_index_dir, keep_existing=not full, resume=local_resume, manifest=embedding_manifest
+    ) if local_index_dir else None
+    keyword_index = KeywordIndex(KEYWORD_INDEX_PATH) if KEYWORD_INDEX_PATH else None
+
+    conn = connect_db(database)
+    # A named cursor keeps the result set on the server and streams it in FETCH_SIZE chunks
+    cursor = conn.cursor(name="apparels_ingest")
+    cursor.itersize = FETCH_SIZE
+    columns = "id, pdt_desc, uri" + (f", {PRICE_COLUMN}" if PRICE_COLUMN else "")
+    cursor.execute(
+        f"SELECT {columns} FROM apparels WHERE id > %s ORDER BY id",
+        (last_id if last_id is not None else -1,)
+    )
+
+    start = time.perf_counter()
+    seen = 0
+    # Counts the rows the interrupted run embedded too, or a resumed run would take a changed catalog for an unchanged one
+    embedded = resumed_embedded
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        seen += len(rows)
+
+        metadatas = [product_metadata(row) for row in rows]
+        hashes = [metadata_hash(metadata) for metadata in metadatas]
+        changed = [
+            row for row, content_hash in zip(rows, hashes)
+            if previous is None or previous.hash_of(row[0]) != content_hash
+        ]
+        vectors = encode_rows(model, changed)
+        embedded += len(vectors)
+
+        encoded = {vector["id"]: vector["values"] for vector in vectors}
+        ids = [str(row[0]) for row in rows]
+        row_vectors = [
+            encoded[id] if id in encoded else previous.embeddings[previous.row_of(id)]
+            for id in ids
+        ]
+        snapshot_writer.add(ids, row_vectors, metadatas, hashes)
+        snapshot_writer.flush()
+
+        checkpoint = {"last_id": rows[-1][0], "snapshot_rows": snapshot_writer.rows, "embedded": embedded}
+        if local_writer:
+            if local_gets_all_rows:
+                # Unchanged rows reuse their snapshot vectors
+                local_writer.add(ids, row_vectors, metadatas)
+            elif vectors:
+                local_writer.add(
+                    [vector["id"] for vector in vectors],
+                    [vector["values"] for vector in vectors],
+                    [vector["metadata"] for vector in vectors]
+                )
+            local_writer.flush()
+            checkpoint["local_rows"] = local_writer.rows
+            checkpoint["local_dim"] = local_writer.dim
+
+        if keyword_index:
+            # The keyword index keeps its own hashes, so a new one is backfilled from all rows
+            update_keyword_index(keyword_index, rows)
+
+        write_checkpoint(state, checkpoint)
+        elapsed = time.perf_counter() - start
+        print(f"done : {seen} rows read, {embedded} embedded ({seen / elapsed:.0f} rows/s)")
+
+    cursor.close()
+    conn.close()
+
+    if previous is not None and not embedded and snapshot_writer.rows == len(previous):
+        # Every product matched the latest snapshot: nothing to publish
+        snapshot_writer.discard()
+        catalog = previous
+        deleted_ids = []
+    else:
+        catalog = snapshot.load(snapshot_writer.close())
+        deleted_ids = [] if previous is None else [id for id in previous.ids.tolist() if catalog.row_of(id) is None]
+
+    if local_writer:
+        local_writer.close(deleted_ids=deleted_ids, version=catalog.version)
+    if keyword_index:
+        if deleted_ids:
+            keyword_index.delete(deleted_ids)
+        print(f"Keyword index at {KEYWORD_INDEX_PATH} holds {len(keyword_index)} products")
+        keyword_index.close()
+
+    # The run is complete, the next one starts from the top and relies on the snapshot's hashes
+    state.execute("DELETE FROM checkpoint")
+    state.commit()
+    state.close()
+
+    alias = read_pinecone_manifest(index) or {}
+    if catalog is previous and alias.get("version") == catalog.version:
+        print(f"Catalog unchanged, the index already serves snapshot {catalog.version}")
+    else:
+        namespaces = publish(index, catalog, full=full)
+        # Cached chat responses were built from the old vectors
+        bump_catalog_version()
+        snapshot.prune(SNAPSHOT_KEEP, protected={entry["version"] for entry in namespaces.values()})
+    print(f"upsert completed: {seen} rows read, {embedded} re-embedded in {time.perf_counter() - start:.1f}s")
 
 
-# index.upsert(vectors=vectors)
-print("upsert completed")
\ No newline at end of file
+if __name__ == "__main__":
+    # --full re-embeds every row instead of only new or changed ones and rewrites
+    # the inactive namespace whole; --rollback switches the alias back
+    if "--rollback" in sys.argv:
+        rollback(resources.get_pinecone_index())
+    else:
+        ingest(full="--full" in sys.argv)
@@ -0,0 +1,56 @@
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+from attributes import parse_attributes
+
+# Cache of LLM rewrites keyed on the context and the current query
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+stats = {"skipped": 0, "hits": 0, "misses": 0}
+
+
+def _key(user_query, context):
+    normalize = lambda text: " ".join(text.lower().split())
+    return (tuple(normalize(query) for query in context), normalize(user_query))
+
+
+def is_self_contained(user_query, context):
+    # A query naming its own product category doesn't need the earlier queries,
+    # unless they set a gender it doesn't repeat ("for boys" carries over, colors don't)
+    query_attributes = parse_attributes(user_query)
+    if query_attributes["category"] is None:
+        return False
+    context_genders = {parse_attributes(query)["gender"] for query in context} - {None}
+    return not context_genders or query_attributes["gender"] is not None
+
+
+def local_rewrite(user_query, context):
+    """Rewritten query when it can be had without the LLM, otherwise None."""
+    if not context or is_self_contained(user_query, context):
+        stats["skipped"] += 1
+        metrics.count("query_rewrite.skipped")
+        return user_query
+
+    key = _key(user_query, context)
+    with _cache_lock:
+        structured_query = _cache.get(key)
+        if structured_query is not None:
+            _cache.move_to_end(key)
+            stats["hits"] += 1
+            metrics.count("query_rewrite.hit")
+            return structured_query
+        stats["misses"] += 1
+    metrics.count("query_rewrite.miss")
+    return None
+
+
+def remember_rewrite(user_query, context, structured_query):
+    key = _key(user_query, context)
+    with _cache_lock:
+        _cache[key] = structured_query
+        _cache.move_to_end(key)
+        while len(_cache) > int(os.getenv("REWRITE_CACHE_SIZE", "4096")):
+            _cache.popitem(last=False)
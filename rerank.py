@@ -0,0 +1,122 @@
+import math
+import os
+
+import resources
+from attributes import GENDERS, canonical_category, canonical_color, parse_attributes, tokenize
+
+# Words that say nothing about which product is wanted
+STOPWORDS = {
+    "a", "an", "the", "for", "with", "and", "or", "in", "of", "to", "on", "me", "my", "i",
+    "want", "need", "show", "give", "find", "some", "any", "looking", "color", "colour",
+}
+
+
+def _terms(text):
+    terms = set()
+    for token in tokenize(text):
+        if token in STOPWORDS:
+            continue
+        # Compare by canonical form so "shoe" matches "shoes" and "gray" matches "grey"
+        terms.add(GENDERS.get(token) or canonical_category(token) or canonical_color(token) or token)
+    return terms
+
+
+def _passes_attributes(query_attributes, description_terms):
+    # Same hard rules the LLM prompt spells out: exact category and exact color
+    if query_attributes["category"] and query_attributes["category"] not in description_terms:
+        return False
+    if query_attributes["color"] and query_attributes["color"] not in description_terms:
+        return False
+    gender = query_attributes["gender"]
+    description_genders = description_terms & set(GENDERS.values())
+    if gender and description_genders and gender not in description_genders and "unisex" not in description_genders:
+        return False
+    return True
+
+
+def _cross_encoder_scores(structured_query, product_list):
+    model = resources.get_cross_encoder()
+    logits = model.predict([(structured_query, product["description"]) for product in product_list])
+    return [1 / (1 + math.exp(-float(logit))) for logit in logits]
+
+
+def rerank(structured_query, product_list, max_results=4, min_match=85):
+    """Rerank retrieved products locally, returning (suggestions_json, confidence).
+
+    suggestions_json has the same shape as the LLM's function call output.
+    confidence is the margin between the weakest result and the best candidate
+    that fell below min_match, so a close call at the cutoff is left to the
+    LLM. It is 0 when the local result shouldn't be trusted at all, e.g. the
+    query names no product category (greetings, general fashion questions) or
+    nothing passed the filters.
+    """
+    query_attributes = parse_attributes(structured_query)
+    if query_attributes["category"] is None:
+        return None, 0.0
+
+    query_terms = _terms(structured_query)
+    use_cross_encoder = bool(os.getenv("RERANKER_MODEL"))
+    model_scores = _cross_encoder_scores(structured_query, product_list) if use_cross_encoder and product_list else None
+
+    scored = []
+    for position, product in enumerate(product_list):
+        description_terms = _terms(product["description"])
+        if not _passes_attributes(query_attributes, description_terms):
+            continue
+        if model_scores is not None:
+            relevance = model_scores[position]
+        else:
+            # Share of the query's keywords found in the description
+            relevance = len(query_terms & description_terms) / max(len(query_terms), 1)
+        scored.append((relevance, product.get("score", 0.0), product))
+
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    results = [
+        {
+            "match": product["description"],
+            "match_percentage": round(relevance * 100, 1),
+            "product_url": product["uri"],
+            "product_description": product["description"]
+        }
+        for relevance, _, product in scored
+        if relevance * 100 >= min_match
+    ][:max_results]
+
+    if not results:
+        return None, 0.0
+    runner_up = max((relevance for relevance, _, _ in scored if relevance * 100 < min_match), default=0.0)
+    confidence = round(results[-1]["match_percentage"] / 100 - runner_up, 3)
+    return {"query": structured_query, "results": results}, confidence
+
+
+def rerank_locally(structured_query, product_list):
+    """Local suggestions when RERANKER=local and they clear RERANK_CONFIDENCE, otherwise None."""
+    if os.getenv("RERANKER", "local") != "local":
+        return None
+    suggestions_json, confidence = rerank(structured_query, product_list)
+    if confidence < float(os.getenv("RERANK_CONFIDENCE", "0.1")):
+        return None
+    return suggestions_json
+
+
+def vector_ranked(structured_query, product_list, max_results=4):
+    """Suggestions in retrieval order, for when the LLM reranker is unavailable.
+
+    Products that break the query's category/color/gender come last; the
+    match percentage is the dense similarity (0 for keyword-only matches).
+    """
+    query_attributes = parse_attributes(structured_query)
+    ordered = sorted(
+        product_list,
+        key=lambda product: not _passes_attributes(query_attributes, _terms(product["description"]))
+    )
+    results = [
+        {
+            "match": product["description"],
+            "match_percentage": round(max(min(product.get("similarity", product.get("score", 0.0)), 1.0), 0.0) * 100, 1),
+            "product_url": product["uri"],
+            "product_description": product["description"]
+        }
+        for product in ordered[:max_results]
+    ]
+    return {"query": structured_query, "results": results}
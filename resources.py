@@ -0,0 +1,263 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+import metrics
+
+EMBEDDING_MODEL_NAME = "all-mpnet-base-v2"
+PINECONE_INDEX_NAME = "shopping-chatbot"
+
+# Process-wide registry of the expensive retrieval resources. Each one is built
+# lazily on first use and then shared by every Streamlit session in the process.
+_resources = {}
+_locks = {}
+_locks_guard = threading.Lock()
+_configured = False
+
+# Seconds spent building each resource, plus "warm_up" and "first_query"
+timings = {}
+
+
+def configure():
+    global _configured
+    if not _configured:
+        load_dotenv()
+        _configured = True
+
+
+def _get_or_create(name, loader):
+    resource = _resources.get(name)
+    if resource is not None:
+        return resource
+
+    with _locks_guard:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    # Only one thread builds a given resource, the others wait for it
+    with lock:
+        if name not in _resources:
+            configure()
+            start = time.perf_counter()
+            with metrics.span(f"load.{name}"):
+                _resources[name] = loader()
+            timings[name] = time.perf_counter() - start
+            print(f"Loaded {name} in {timings[name]:.2f}s")
+        return _resources[name]
+
+
+def override(name, resource):
+    """Install a stand-in for a resource (e.g. the fakes in benchmark.py) instead of loading it."""
+    _resources[name] = resource
+
+
+def embedding_config():
+    """Embedding model, EMBEDDING_MODE and output dimension (None for the model's own)."""
+    configure()
+    dim = os.getenv("EMBEDDING_DIM")
+    return {
+        "model": os.getenv("EMBEDDING_MODEL", EMBEDDING_MODEL_NAME),
+        "mode": os.getenv("EMBEDDING_MODE", "float32"),
+        "dim": int(dim) if dim else None,
+    }
+
+
+def _load_model():
+    from embedding import load_model
+    config = embedding_config()
+    return load_model(config["model"], config["mode"], config["dim"])
+
+
+def _load_openai_client():
+    from openai import OpenAI
+
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        raise ValueError("OpenAI API key is missing. Please set the OPENAI_API_KEY environment variable or add it to your .env file.")
+    # Retries happen in scheduler.call, within each stage's deadline
+    return OpenAI(api_key=openai_api_key, max_retries=0)
+
+
+def _load_async_openai_client():
+    from openai import AsyncOpenAI
+
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        raise ValueError("OpenAI API key is missing. Please set the OPENAI_API_KEY environment variable or add it to your .env file.")
+    return AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+
+
+def _load_event_loop():
+    # Async clients stay bound to the loop they first ran on, so every async
+    # pipeline call in the process runs on this one background loop
+    import asyncio
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="pipeline-event-loop", daemon=True).start()
+    return loop
+
+
+def _load_pinecone_index():
+    from pinecone import Pinecone
+
+    pinecone_api_key = os.getenv("PINECONE_API_KEY")
+    pc = Pinecone(api_key=pinecone_api_key)
+    return pc.Index(PINECONE_INDEX_NAME)
+
+
+def _load_embedding_cache():
+    from embedding_cache import EmbeddingCache
+
+    # Keyed on the whole configuration, vectors from another mode or dimension are never served
+    config = embedding_config()
+    return EmbeddingCache(
+        f"{config['model']}/{config['mode']}/{config['dim'] or 'full'}",
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")),
+        ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", "86400")),
+        path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+    )
+
+
+def _load_response_cache():
+    from response_cache import ResponseCache
+
+    return ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "4096")),
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    )
+
+
+def _load_retrieval_backend():
+    from embedding import check_compatible
+    from retrieval import LocalBackend, PineconeBackend
+
+    backend = os.getenv("RETRIEVAL_BACKEND", "pinecone")
+    if backend == "local":
+        retrieval_backend = LocalBackend(
+            os.getenv("LOCAL_INDEX_DIR", "local_index"),
+            nprobe=int(os.getenv("LOCAL_INDEX_NPROBE", "8")),
+        )
+    elif backend == "pinecone":
+        retrieval_backend = PineconeBackend(get_pinecone_index())
+    else:
+        raise ValueError(f"Unknown RETRIEVAL_BACKEND {backend!r}, expected 'pinecone' or 'local'.")
+    # Refuse to start rather than answer every query from the wrong embedding space
+    check_compatible(retrieval_backend.manifest, embedding_config(), f"The {backend} index")
+    return retrieval_backend
+
+
+def _load_keyword_index():
+    # Optional: without a BM25 index built by pinecone_setup.py, retrieval is dense only
+    path = os.getenv("KEYWORD_INDEX_PATH")
+    if not path or not os.path.exists(path):
+        return None
+    from keyword_index import KeywordIndex
+    return KeywordIndex(path, max_candidates=int(os.getenv("KEYWORD_MAX_CANDIDATES", "500")))
+
+
+def _load_cross_encoder():
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(os.getenv("RERANKER_MODEL"))
+
+
+def get_model():
+    return _get_or_create("model", _load_model)
+
+
+def get_openai_client():
+    return _get_or_create("openai_client", _load_openai_client)
+
+
+def get_async_openai_client():
+    return _get_or_create("async_openai_client", _load_async_openai_client)
+
+
+def get_cross_encoder():
+    return _get_or_create("cross_encoder", _load_cross_encoder)
+
+
+def get_event_loop():
+    return _get_or_create("event_loop", _load_event_loop)
+
+
+def get_pinecone_index():
+    return _get_or_create("pinecone_index", _load_pinecone_index)
+
+
+def get_embedding_cache():
+    return _get_or_create("embedding_cache", _load_embedding_cache)
+
+
+def get_response_cache():
+    return _get_or_create("response_cache", _load_response_cache)
+
+
+def get_keyword_index():
+    return _get_or_create("keyword_index", _load_keyword_index)
+
+
+def _encode_in_process(texts):
+    return get_model().encode(texts)
+
+
+def encode_batch(texts):
+    """Encode texts with the model, in the worker service's process pool when there is one."""
+    executor = get_cpu_executor()
+    if executor is None:
+        return _encode_in_process(texts)
+    return executor.submit(_encode_in_process, texts).result()
+
+
+def _load_embedding_batcher():
+    # EMBEDDING_BATCH_SIZE=1 turns batching off, every query is encoded on its own
+    max_batch = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+    if max_batch <= 1:
+        return None
+    from embedding_batcher import EmbeddingBatcher
+    return EmbeddingBatcher(
+        encode_batch,
+        max_batch=max_batch,
+        max_wait=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000,
+    )
+
+
+def get_embedding_batcher():
+    return _get_or_create("embedding_batcher", _load_embedding_batcher)
+
+
+def get_cpu_executor():
+    """Executor for the CPU-bound pipeline steps, installed by worker.py; None means a thread."""
+    return _resources.get("cpu_executor")
+
+
+def get_retrieval_backend():
+    return _get_or_create("retrieval_backend", _load_retrieval_backend)
+
+
+def warm_up():
+    """Build every retrieval resource up front and return the load timings."""
+    if "warm_up" in timings:
+        return timings
+
+    start = time.perf_counter()
+    get_model()
+    get_embedding_cache()
+    get_response_cache()
+    get_openai_client()
+    get_retrieval_backend()
+    get_keyword_index()
+    timings["warm_up"] = time.perf_counter() - start
+    print(f"Retrieval resources warmed up in {timings['warm_up']:.2f}s")
+    return timings
+
+
+def warm_up_in_background():
+    thread = threading.Thread(target=warm_up, name="resource-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def record_query_time(seconds):
+    # Only the first query is interesting here, it shows what warm-up saved
+    if "first_query" not in timings:
+        timings["first_query"] = seconds
+        print(f"First query answered in {seconds:.2f}s")
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+from embedding_cache import normalize_query
+
+CATALOG_VERSION_KEY = "shopping:catalog_version"
+
+
+def _catalog_version_file():
+    return os.getenv("CATALOG_VERSION_FILE", "catalog_version")
+
+
+def bump_catalog_version():
+    """Mark the catalog as changed; called by pinecone_setup.py after a re-index.
+
+    Every cached response was keyed on the previous version, so none of them
+    is served again.
+    """
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    tmp_path = _catalog_version_file() + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, _catalog_version_file())
+
+    shared = _connect_shared_tier()
+    if shared is not None:
+        shared.set(CATALOG_VERSION_KEY, version)
+    print(f"Catalog version is now {version}")
+    return version
+
+
+def _connect_shared_tier():
+    url = os.getenv("RESPONSE_CACHE_REDIS_URL")
+    if not url:
+        return None
+    try:
+        import redis
+    except ImportError:
+        print("RESPONSE_CACHE_REDIS_URL is set but the redis package isn't installed, using the local cache only")
+        return None
+    return redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+
+
+class ResponseCache:
+    """Whole-response cache in front of embedding, retrieval and reranking.
+
+    Keyed on the normalized rewritten query, the catalog version and the
+    snapshot version the retrieval backend searched (index_version). The local
+    tier is a per-process LRU; the optional shared tier is Redis, so workers
+    and restarts reuse each other's answers.
+    """
+
+    def __init__(self, max_entries=4096, ttl_seconds=3600, version_check_seconds=10):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self.shared = _connect_shared_tier()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._local = OrderedDict()  # key -> (suggestions_json, stored_at)
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+
+    def catalog_version(self):
+        # Re-read at most every version_check_seconds, a few seconds of stale answers after a re-index is fine
+        now = time.monotonic()
+        if self._version is not None and now - self._version_checked_at < self.version_check_seconds:
+            return self._version
+
+        version = None
+        if self.shared is not None:
+            try:
+                value = self.shared.get(CATALOG_VERSION_KEY)
+                version = value.decode() if value else None
+            except Exception as e:
+                print(f"Couldn't read the catalog version from the shared cache: {e}")
+        if version is None and os.path.exists(_catalog_version_file()):
+            with open(_catalog_version_file()) as f:
+                version = f.read().strip()
+        version = version or "unversioned"
+
+        with self._lock:
+            if version != self._version:
+                # Entries for the old catalog can never be hit again
+                self._local.clear()
+            self._version = version
+            self._version_checked_at = now
+        return version
+
+    def _key(self, structured_query, index_version):
+        text = f"{self.catalog_version()}\x00{index_version or ''}\x00{normalize_query(structured_query)}"
+        return "shopping:response:" + hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, structured_query, index_version=None):
+        key = self._key(structured_query, index_version)
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl_seconds:
+                self._local.move_to_end(key)
+                self.hits += 1
+                metrics.count("response_cache.hit")
+                return entry[0]
+
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                print(f"Shared response cache unavailable: {e}")
+                value = None
+            if value is not None:
+                suggestions_json = json.loads(value)
+                self._put_local(key, suggestions_json)
+                with self._lock:
+                    self.shared_hits += 1
+                metrics.count("response_cache.shared_hit")
+                return suggestions_json
+
+        with self._lock:
+            self.misses += 1
+        metrics.count("response_cache.miss")
+        return None
+
+    def _put_local(self, key, suggestions_json):
+        with self._lock:
+            self._local[key] = (suggestions_json, time.time())
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def put(self, structured_query, suggestions_json, index_version=None):
+        if not suggestions_json:
+            return
+        key = self._key(structured_query, index_version)
+        self._put_local(key, suggestions_json)
+        if self.shared is not None:
+            try:
+                self.shared.setex(key, int(self.ttl_seconds), json.dumps(suggestions_json))
+            except Exception as e:
+                print(f"Shared response cache unavailable: {e}")
+
+    def stats(self):
+        return {"entries": len(self._local), "hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses}
@@ -0,0 +1,436 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import scheduler
+
+
+class RetrievalBackend:
+    """Vector search used by build_suggestions_json.
+
+    query() returns matches shaped like Pinecone's:
+    [{"id": ..., "score": ..., "metadata": {"description": ..., "uri": ...}}]
+    filter is a metadata filter in Pinecone's syntax (see attributes.query_filter).
+    manifest is what the index recorded about its embeddings (embedding.manifest),
+    None for an index written before it did.
+    """
+
+    manifest = None
+
+    @property
+    def version(self):
+        # The catalog snapshot being searched, for indexes published from one
+        return (self.manifest or {}).get("version")
+
+    def check_query_vector(self, vector):
+        dim = self.manifest["dim"] if self.manifest else None
+        if dim and len(vector) != dim:
+            raise ValueError(f"Query vector has {len(vector)} dimensions but the index holds {dim}-dimensional vectors")
+
+    def query(self, vector, top_k, filter=None):
+        return self.query_batch([vector], top_k, filter=filter)[0]
+
+    def query_batch(self, vectors, top_k, filter=None):
+        return [self.query(vector, top_k, filter=filter) for vector in vectors]
+
+
+# The manifest is kept as the only vector in a namespace of its own, so queries never see it
+MANIFEST_NAMESPACE = "__manifest__"
+MANIFEST_ID = "manifest"
+
+# The manifest is also the index's alias. Catalog versions are published to
+# these namespaces in turn; "namespace" names the one queries go to and
+# "versions" the snapshot each holds. Rewriting the manifest (a single upsert)
+# switches every app to the other namespace at once, and back for a rollback.
+CATALOG_NAMESPACES = ("catalog-a", "catalog-b")
+
+
+def read_pinecone_manifest(index):
+    response = index.fetch(ids=[MANIFEST_ID], namespace=MANIFEST_NAMESPACE)
+    vectors = response["vectors"] if isinstance(response, dict) else response.vectors
+    if MANIFEST_ID not in vectors:
+        return None
+    vector = vectors[MANIFEST_ID]
+    metadata = vector["metadata"] if isinstance(vector, dict) else vector.metadata
+    return json.loads(metadata["manifest"])
+
+
+def write_pinecone_manifest(index, manifest):
+    values = [0.0] * manifest["dim"]
+    values[0] = 1.0
+    index.upsert(
+        vectors=[{"id": MANIFEST_ID, "values": values, "metadata": {"manifest": json.dumps(manifest)}}],
+        namespace=MANIFEST_NAMESPACE
+    )
+
+
+class PineconeBackend(RetrievalBackend):
+    """Queries the namespace the index's alias points at, re-reading it every refresh_seconds."""
+
+    def __init__(self, index, refresh_seconds=None):
+        self.index = index
+        if refresh_seconds is None:
+            refresh_seconds = float(os.getenv("PINECONE_ALIAS_REFRESH", "30"))
+        self.refresh_seconds = refresh_seconds
+        self.manifest = read_pinecone_manifest(index)
+        # An index from before versioned namespaces keeps its vectors in the default one
+        self.namespace = (self.manifest or {}).get("namespace", "")
+        self._alias_read = time.monotonic()
+
+    def _refresh_alias(self):
+        if not self.refresh_seconds or time.monotonic() - self._alias_read < self.refresh_seconds:
+            return
+        self._alias_read = time.monotonic()
+        try:
+            manifest = read_pinecone_manifest(self.index)
+        except Exception as e:
+            print(f"Couldn't re-read the index alias, still querying {self.namespace!r}: {e}")
+            return
+        if not manifest or manifest.get("namespace", "") == self.namespace:
+            return
+        current = self.manifest or {}
+        if (manifest["model"], manifest.get("truncate_dim")) != (current.get("model"), current.get("truncate_dim")):
+            # Vectors from this process's model can't search the new version; that takes a restart
+            print(f"Index alias moved to {manifest['namespace']!r} with {manifest['model']} embeddings, "
+                  f"still querying {self.namespace!r} until restarted with that model")
+            return
+        print(f"Index alias moved from {self.namespace!r} to {manifest['namespace']!r}")
+        self.manifest = manifest
+        self.namespace = manifest["namespace"]
+
+    def query(self, vector, top_k, filter=None):
+        self._refresh_alias()
+        self.check_query_vector(vector)
+        # Values are never used downstream, so don't ship them back over the network.
+        # Rate limits, retries and the deadline come from the shared scheduler
+        response = scheduler.call(
+            "pinecone", "vector_query", self.index.query,
+            timeout_argument="_request_timeout",
+            namespace=self.namespace,
+            vector=vector,
+            top_k=top_k,
+            filter=filter,
+            include_values=False,
+            include_metadata=True
+        )
+        return [
+            {"id": match["id"], "score": match["score"], "metadata": match["metadata"]}
+            for match in response["matches"]
+        ]
+
+
+def matches_filter(metadata, filter):
+    """Whether metadata passes a Pinecone-style filter ($eq, $ne, $in, $nin, $and, $or).
+
+    As in Pinecone, a list value matches when any of its elements does.
+    """
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, part) for part in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, part) for part in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        values = set(value) if isinstance(value, list) else {value}
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            if operator == "$eq" and operand not in values:
+                return False
+            if operator == "$ne" and operand in values:
+                return False
+            if operator == "$in" and not values & set(operand):
+                return False
+            if operator == "$nin" and values & set(operand):
+                return False
+    return True
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, top_k):
+    top_k = min(top_k, scores.shape[0])
+    if top_k == 0:
+        return np.array([], dtype=np.int64)
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    return best[np.argsort(-scores[best])]
+
+
+class LocalBackend(RetrievalBackend):
+    """In-process index over the catalog embeddings written by LocalIndexWriter.
+
+    Vectors are memory-mapped from disk and searched by dot product (they are
+    stored normalized, so this is cosine similarity). If the index was written
+    with IVF lists, only the nprobe closest lists are scanned per query.
+    Every refresh_seconds the directory's manifest is re-read, and once
+    pinecone_setup.py has written another snapshot version there, queries go
+    to the reopened index.
+    """
+
+    def __init__(self, directory, nprobe=8, refresh_seconds=None):
+        self.directory = directory
+        self.nprobe = nprobe
+        if refresh_seconds is None:
+            refresh_seconds = float(os.getenv("LOCAL_INDEX_REFRESH", "30"))
+        self.refresh_seconds = refresh_seconds
+        self._current = self
+        self._manifest_read = time.monotonic()
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "records.jsonl")) as f:
+            records = [json.loads(line) for line in f]
+        self.ids = [record["id"] for record in records]
+        self.metadata = [record["metadata"] for record in records]
+        self._filtered_rows = {}
+
+        manifest_path = os.path.join(directory, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+        self.centroids = None
+        centroids_path = os.path.join(directory, "ivf_centroids.npy")
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.list_order = np.load(os.path.join(directory, "ivf_order.npy"), mmap_mode="r")
+            self.list_offsets = np.load(os.path.join(directory, "ivf_offsets.npy"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def version(self):
+        return (self._current.manifest or {}).get("version")
+
+    def _reopen_if_changed(self):
+        # The index to search; a reopened one is a whole new object, so a query
+        # in flight never mixes the vectors of one version with the rows of another
+        current = self._current
+        if not self.refresh_seconds or time.monotonic() - self._manifest_read < self.refresh_seconds:
+            return current
+        self._manifest_read = time.monotonic()
+        manifest_path = os.path.join(self.directory, "manifest.json")
+        if not os.path.exists(manifest_path):
+            # An index written without a manifest has no version to follow
+            return current
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == current.version:
+                return current
+            old = current.manifest or {}
+            if (manifest["model"], manifest.get("truncate_dim")) != (old.get("model"), old.get("truncate_dim")):
+                print(f"Local index moved to snapshot {manifest.get('version')} with {manifest['model']} embeddings, "
+                      f"still searching {current.version} until restarted with that model")
+                return current
+            reopened = LocalBackend(self.directory, self.nprobe, refresh_seconds=0)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Couldn't reopen the local index, still searching snapshot {current.version}: {e}")
+            return current
+        print(f"Local index moved from snapshot {current.version} to {reopened.version}")
+        self._current = reopened
+        return reopened
+
+    def _match(self, row, score):
+        return {"id": self.ids[row], "score": float(score), "metadata": self.metadata[row]}
+
+    def _rows_matching(self, filter):
+        # Rows passing a filter, remembered since the same few filters repeat across queries
+        key = json.dumps(filter, sort_keys=True)
+        rows = self._filtered_rows.get(key)
+        if rows is None:
+            rows = np.array([row for row, metadata in enumerate(self.metadata) if matches_filter(metadata, filter)], dtype=np.int64)
+            if len(self._filtered_rows) >= 1024:
+                self._filtered_rows.clear()
+            self._filtered_rows[key] = rows
+        return rows
+
+    def _search_rows(self, query, top_k, rows):
+        scores = np.asarray(self.vectors[rows] @ query)
+        best = _top_k(scores, top_k)
+        return [self._match(rows[i], scores[i]) for i in best]
+
+    def _search_ivf(self, query, top_k, allowed_rows=None):
+        lists = _top_k(self.centroids @ query, self.nprobe)
+        rows = np.sort(np.concatenate([
+            self.list_order[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists
+        ]))
+        if allowed_rows is not None:
+            rows = np.intersect1d(rows, allowed_rows, assume_unique=True)
+        return self._search_rows(query, top_k, rows)
+
+    def query_batch(self, vectors, top_k, filter=None):
+        current = self._reopen_if_changed()
+        if current is not self:
+            return current.query_batch(vectors, top_k, filter=filter)
+        for vector in vectors:
+            self.check_query_vector(vector)
+        queries = _normalize(vectors)
+        if filter:
+            allowed_rows = self._rows_matching(filter)
+            # A selective filter leaves few enough rows to scan them all exactly
+            if self.centroids is None or len(allowed_rows) * self.centroids.shape[0] <= len(self) * self.nprobe:
+                return [self._search_rows(query, top_k, allowed_rows) for query in queries]
+            return [self._search_ivf(query, top_k, allowed_rows) for query in queries]
+        if self.centroids is not None:
+            return [self._search_ivf(query, top_k) for query in queries]
+
+        # Brute force, one matrix product for the whole batch
+        scores = np.asarray(self.vectors @ queries.T).T
+        results = []
+        for query_scores in scores:
+            best = _top_k(query_scores, top_k)
+            results.append([self._match(row, query_scores[row]) for row in best])
+        return results
+
+
+def _train_ivf(vectors, n_lists, iterations=10, sample_size=20000, seed=0):
+    # Spherical k-means on a sample, good enough to partition the catalog
+    rng = np.random.default_rng(seed)
+    sample_rows = rng.choice(vectors.shape[0], size=min(sample_size, vectors.shape[0]), replace=False)
+    sample = np.asarray(vectors[np.sort(sample_rows)])
+    centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for l in range(n_lists):
+            members = sample[assignment == l]
+            if len(members):
+                centroids[l] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class LocalIndexWriter:
+    """Streams (id, vector, metadata) rows into a LocalBackend directory.
+
+    Rows go to a temporary directory and replace the live one only in close(),
+    so a reader never sees a half-written index. Rows of the existing index
+    that were not rewritten are carried over unless listed in deleted_ids.
+    resume=(rows, dim) reopens the temporary directory of an interrupted run.
+    manifest (see embedding.manifest) is recorded as manifest.json, along with
+    the snapshot version passed to close().
+    """
+
+    def __init__(self, directory, ivf_min_rows=50000, keep_existing=True, resume=None, manifest=None):
+        self.directory = directory
+        self.manifest = manifest
+        self.ivf_min_rows = ivf_min_rows
+        self.keep_existing = keep_existing
+        self.tmp_directory = directory + ".tmp"
+        self._written_ids = set()
+        self._rows = 0
+        self._dim = None
+
+        raw_path = os.path.join(self.tmp_directory, "vectors.raw")
+        records_path = os.path.join(self.tmp_directory, "records.jsonl")
+        if resume and os.path.exists(raw_path):
+            self._resume(raw_path, records_path, *resume)
+            self._raw = open(raw_path, "ab")
+            self._records = open(records_path, "a")
+        else:
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+            os.makedirs(self.tmp_directory)
+            self._raw = open(raw_path, "wb")
+            self._records = open(records_path, "w")
+
+    @property
+    def dim(self):
+        return self._dim
+
+    @property
+    def rows(self):
+        return self._rows
+
+    def _resume(self, raw_path, records_path, rows, dim):
+        # Drop whatever an interrupted run wrote after its last checkpoint
+        with open(records_path) as f:
+            records = [line for _, line in zip(range(rows), f)]
+        with open(records_path, "w") as f:
+            f.writelines(records)
+        with open(raw_path, "r+b") as f:
+            f.truncate(len(records) * (dim or 0) * 4)
+        self._written_ids = {json.loads(line)["id"] for line in records}
+        self._rows = len(records)
+        self._dim = dim
+
+    def add(self, ids, vectors, metadatas):
+        vectors = _normalize(vectors)
+        self._dim = vectors.shape[1]
+        self._raw.write(vectors.tobytes())
+        for id, metadata in zip(ids, metadatas):
+            self._records.write(json.dumps({"id": str(id), "metadata": metadata}) + "\n")
+            self._written_ids.add(str(id))
+        self._rows += len(ids)
+
+    def flush(self):
+        self._raw.flush()
+        self._records.flush()
+
+    def _carry_over_existing(self, deleted_ids):
+        if not (self.keep_existing and os.path.exists(os.path.join(self.directory, "vectors.npy"))):
+            return
+        existing = LocalBackend(self.directory)
+        keep = [
+            row for row, id in enumerate(existing.ids)
+            if id not in self._written_ids and id not in deleted_ids
+        ]
+        for start in range(0, len(keep), 10000):
+            rows = keep[start:start + 10000]
+            self.add(
+                [existing.ids[row] for row in rows],
+                np.asarray(existing.vectors[rows]),
+                [existing.metadata[row] for row in rows]
+            )
+
+    def close(self, deleted_ids=(), version=None):
+        self._carry_over_existing(set(deleted_ids))
+        self._raw.close()
+        self._records.close()
+
+        raw_path = os.path.join(self.tmp_directory, "vectors.raw")
+        dim = self._dim or 0
+        raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(self._rows, dim)) if self._rows else np.zeros((0, dim), np.float32)
+        vectors = np.lib.format.open_memmap(
+            os.path.join(self.tmp_directory, "vectors.npy"), mode="w+", dtype=np.float32, shape=(self._rows, dim)
+        )
+        for start in range(0, self._rows, 10000):
+            vectors[start:start + 10000] = raw[start:start + 10000]
+        vectors.flush()
+        del raw
+        os.remove(raw_path)
+
+        if self._rows >= self.ivf_min_rows:
+            self._write_ivf(vectors)
+        if self.manifest:
+            with open(os.path.join(self.tmp_directory, "manifest.json"), "w") as f:
+                json.dump(dict(self.manifest, dim=dim, version=version), f)
+
+        # Swap the finished index in for the old one
+        old_directory = self.directory + ".old"
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(self.directory):
+            os.replace(self.directory, old_directory)
+        os.replace(self.tmp_directory, self.directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+        print(f"Local index written to {self.directory} with {self._rows} vectors")
+
+    def _write_ivf(self, vectors):
+        n_lists = int(np.sqrt(vectors.shape[0]))
+        centroids = _train_ivf(vectors, n_lists)
+        assignment = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], 10000):
+            assignment[start:start + 10000] = np.argmax(vectors[start:start + 10000] @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        np.save(os.path.join(self.tmp_directory, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(self.tmp_directory, "ivf_order.npy"), order)
+        np.save(os.path.join(self.tmp_directory, "ivf_offsets.npy"), offsets)
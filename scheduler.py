@@ -0,0 +1,233 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+# Shared scheduling for calls to external services (OpenAI, Pinecone). Each
+# service has a concurrency limit and a token bucket; each pipeline stage has a
+# deadline, retries with jittered backoff inside it, and optionally hedges:
+# a second identical request once the first has been slow for a while.
+#
+# Configured from the environment, e.g. SCHEDULER_OPENAI_CONCURRENCY,
+# SCHEDULER_OPENAI_RATE, SCHEDULER_QUERY_REWRITE_DEADLINE,
+# SCHEDULER_VECTOR_QUERY_HEDGE_AFTER.
+
+DEFAULT_DEADLINES = {"query_rewrite": 4.0, "rerank": 10.0, "vector_query": 3.0}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def _setting(name, default):
+    return float(os.getenv(f"SCHEDULER_{name.upper()}", str(default)))
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst saved up; rate 0 means unlimited."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            if now + wait_seconds > deadline:
+                raise DeadlineExceeded("rate limit wait would pass the deadline")
+            time.sleep(wait_seconds)
+
+
+class Service:
+    def __init__(self, name):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(int(_setting(f"{name}_concurrency", 16)))
+        self.bucket = TokenBucket(_setting(f"{name}_rate", 0), _setting(f"{name}_burst", 10))
+
+    def acquire(self, deadline):
+        self.bucket.acquire(deadline)
+        if not self.slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise DeadlineExceeded(f"no free {self.name} slot before the deadline")
+
+    def release(self):
+        self.slots.release()
+
+
+_services = {}
+_services_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="scheduler")
+
+
+def _service(name):
+    with _services_lock:
+        if name not in _services:
+            _services[name] = Service(name)
+        return _services[name]
+
+
+def is_retryable(error):
+    """Rate limits, timeouts, connection errors and server errors are worth retrying."""
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in (408, 409, 429) or status >= 500
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or "Timeout" in name or "Connection" in name
+
+
+def _backoff(attempt):
+    # Full jitter, so clients that failed together don't retry together
+    base = _setting("retry_base_delay", 0.2)
+    return random.uniform(0, min(_setting("retry_max_delay", 2.0), base * 2 ** attempt))
+
+
+def _plan(stage, timeout):
+    if timeout is None:
+        timeout = _setting(f"{stage}_deadline", DEFAULT_DEADLINES.get(stage, 10.0))
+    return time.monotonic() + timeout, _setting(f"{stage}_hedge_after", 0), int(_setting(f"{stage}_retries", 2))
+
+
+def _with_request_timeout(kwargs, timeout_argument, deadline):
+    # The client gives up when the stage does, so a stalled request doesn't hold its slot
+    if timeout_argument is None:
+        return kwargs
+    return dict(kwargs, **{timeout_argument: max(deadline - time.monotonic(), 0.001)})
+
+
+def _attempt(service, deadline, timeout_argument, function, args, kwargs):
+    service.acquire(deadline)
+    try:
+        return function(*args, **_with_request_timeout(kwargs, timeout_argument, deadline))
+    finally:
+        service.release()
+
+
+def call(service_name, stage, function, *args, timeout=None, timeout_argument=None, **kwargs):
+    """Run a blocking call to service_name for stage under the scheduler's limits.
+
+    timeout overrides the stage's deadline, in seconds from now. Raises
+    DeadlineExceeded when the deadline passes, or the last error once
+    retries are used up. timeout_argument names function's own request
+    timeout keyword, which is given the time left; otherwise a late call
+    isn't interrupted, it finishes in the background and its result is dropped.
+    """
+    service = _service(service_name)
+    stage_deadline, hedge_after, retries = _plan(stage, timeout)
+    for attempt in range(retries + 1):
+        futures = [_executor.submit(_attempt, service, stage_deadline, timeout_argument, function, args, kwargs)]
+        try:
+            while True:
+                remaining = stage_deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"{stage} took longer than its deadline")
+                # Hedge once: a duplicate request if the first one is slow to answer
+                wait_seconds = min(remaining, hedge_after) if hedge_after and len(futures) == 1 else remaining
+                done, _ = wait(futures, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+                if done:
+                    return next(iter(done)).result()
+                if hedge_after and len(futures) == 1:
+                    metrics.count(f"scheduler.{stage}.hedged")
+                    futures.append(_executor.submit(_attempt, service, stage_deadline, timeout_argument, function, args, kwargs))
+        except DeadlineExceeded:
+            metrics.count(f"scheduler.{stage}.deadline_exceeded")
+            raise
+        except Exception as e:
+            delay = _backoff(attempt)
+            if attempt == retries or not is_retryable(e) or time.monotonic() + delay >= stage_deadline:
+                raise
+            metrics.count(f"scheduler.{stage}.retried")
+            print(f"Retrying {stage} after {type(e).__name__}: {e}")
+            time.sleep(delay)
+
+
+def _release_if_acquired(service):
+    def callback(future):
+        if not future.cancelled() and future.exception() is None:
+            service.release()
+    return callback
+
+
+async def acall(service_name, stage, function, *args, timeout=None, timeout_argument=None, **kwargs):
+    """call() for coroutine functions, on the running event loop."""
+    service = _service(service_name)
+    stage_deadline, hedge_after, retries = _plan(stage, timeout)
+
+    async def attempt():
+        acquiring = asyncio.ensure_future(asyncio.to_thread(service.acquire, stage_deadline))
+        try:
+            # Shielded: a cancelled attempt leaves the thread waiting for a slot, and
+            # hands the slot back below if the thread gets one after all
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(_release_if_acquired(service))
+            raise
+        try:
+            return await function(*args, **_with_request_timeout(kwargs, timeout_argument, stage_deadline))
+        finally:
+            service.release()
+
+    for attempt_number in range(retries + 1):
+        tasks = [asyncio.ensure_future(attempt())]
+        try:
+            while True:
+                remaining = stage_deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"{stage} took longer than its deadline")
+                wait_seconds = min(remaining, hedge_after) if hedge_after and len(tasks) == 1 else remaining
+                done, _ = await asyncio.wait(tasks, timeout=wait_seconds, return_when=asyncio.FIRST_COMPLETED)
+                if done:
+                    return next(iter(done)).result()
+                if hedge_after and len(tasks) == 1:
+                    metrics.count(f"scheduler.{stage}.hedged")
+                    tasks.append(asyncio.ensure_future(attempt()))
+        except DeadlineExceeded:
+            metrics.count(f"scheduler.{stage}.deadline_exceeded")
+            raise
+        except Exception as e:
+            delay = _backoff(attempt_number)
+            if attempt_number == retries or not is_retryable(e) or time.monotonic() + delay >= stage_deadline:
+                raise
+            metrics.count(f"scheduler.{stage}.retried")
+            print(f"Retrying {stage} after {type(e).__name__}: {e}")
+            await asyncio.sleep(delay)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def stage_deadline(stage):
+    """Absolute (time.monotonic) deadline for a stage starting now."""
+    return _plan(stage, None)[0]
+
+
+async def iterate_until(stream, deadline, stage):
+    """Items of an async iterator, raising DeadlineExceeded if it runs past deadline."""
+    iterator = stream.__aiter__()
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            metrics.count(f"scheduler.{stage}.deadline_exceeded")
+            raise DeadlineExceeded(f"{stage} took longer than its deadline")
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), timeout=remaining)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            metrics.count(f"scheduler.{stage}.deadline_exceeded")
+            raise DeadlineExceeded(f"{stage} took longer than its deadline")
+        yield item
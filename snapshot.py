@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+# Versioned catalog snapshots written by pinecone_setup.py. Each version is a
+# directory under SNAPSHOT_DIR holding every product of one ingest run:
+#
+#   embeddings.npy   float16 (rows, dim), memory-mapped on load
+#   ids.npy          product ids, fixed-width strings
+#   hashes.npy       content hash per product, to find what changed between versions
+#   metadata.json    one list per metadata field ("columns"), row-aligned
+#   manifest.json    version, rows and the embedding manifest
+#
+# Versions are named by their UTC creation time, so they sort by age.
+
+
+def snapshot_root():
+    return os.getenv("SNAPSHOT_DIR", "snapshots")
+
+
+def versions(root=None):
+    root = root or snapshot_root()
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name for name in os.listdir(root)
+        if os.path.exists(os.path.join(root, name, "manifest.json"))
+    )
+
+
+def latest_version(root=None):
+    found = versions(root)
+    return found[-1] if found else None
+
+
+class Snapshot:
+    """One version of the catalog, loaded without parsing anything per row."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.version = self.manifest["version"]
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(directory, "ids.npy"))
+        self.hashes = np.load(os.path.join(directory, "hashes.npy"))
+        with open(os.path.join(directory, "metadata.json")) as f:
+            self.columns = json.load(f)
+        self._rows_by_id = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def embedding_manifest(self):
+        return self.manifest["embedding"]
+
+    def row_of(self, id):
+        if self._rows_by_id is None:
+            self._rows_by_id = {id: row for row, id in enumerate(self.ids.tolist())}
+        return self._rows_by_id.get(str(id))
+
+    def hash_of(self, id):
+        row = self.row_of(id)
+        return None if row is None else str(self.hashes[row])
+
+    def metadata(self, row):
+        return {name: values[row] for name, values in self.columns.items() if values[row] is not None}
+
+    def vector(self, row):
+        return self.embeddings[row].astype(np.float32)
+
+
+def load(version=None, root=None):
+    """A snapshot by version, the latest one by default; None if there is none."""
+    root = root or snapshot_root()
+    version = version or latest_version(root)
+    if version is None or not os.path.exists(os.path.join(root, version, "manifest.json")):
+        return None
+    return Snapshot(os.path.join(root, version))
+
+
+class SnapshotWriter:
+    """Streams (id, vector, metadata, hash) rows into a new snapshot version.
+
+    Rows are appended to a build directory and become a version only in
+    close(), so a half-written snapshot is never loaded. resume=rows reopens
+    the build directory of an interrupted run, dropping anything after rows.
+    """
+
+    def __init__(self, embedding_manifest, root=None, resume=None):
+        self.root = root or snapshot_root()
+        self.embedding_manifest = embedding_manifest
+        self.dim = embedding_manifest["dim"]
+        self.build_directory = os.path.join(self.root, ".building")
+        self._rows = 0
+
+        raw_path = os.path.join(self.build_directory, "embeddings.raw")
+        records_path = os.path.join(self.build_directory, "records.jsonl")
+        if resume is not None and os.path.exists(raw_path):
+            self._resume(raw_path, records_path, resume)
+            self._raw = open(raw_path, "ab")
+            self._records = open(records_path, "a")
+        else:
+            shutil.rmtree(self.build_directory, ignore_errors=True)
+            os.makedirs(self.build_directory)
+            self._raw = open(raw_path, "wb")
+            self._records = open(records_path, "w")
+
+    @property
+    def rows(self):
+        return self._rows
+
+    def _resume(self, raw_path, records_path, rows):
+        with open(records_path) as f:
+            records = [line for _, line in zip(range(rows), f)]
+        with open(records_path, "w") as f:
+            f.writelines(records)
+        with open(raw_path, "r+b") as f:
+            f.truncate(len(records) * self.dim * 2)
+        self._rows = len(records)
+
+    def add(self, ids, vectors, metadatas, hashes):
+        vectors = np.asarray(vectors, dtype=np.float16).reshape(len(ids), self.dim)
+        self._raw.write(vectors.tobytes())
+        for id, metadata, content_hash in zip(ids, metadatas, hashes):
+            self._records.write(json.dumps({"id": str(id), "hash": content_hash, "metadata": metadata}) + "\n")
+        self._rows += len(ids)
+
+    def flush(self):
+        self._raw.flush()
+        self._records.flush()
+
+    def discard(self):
+        self._raw.close()
+        self._records.close()
+        shutil.rmtree(self.build_directory, ignore_errors=True)
+
+    def close(self):
+        """Finish the snapshot and return its version."""
+        self._raw.close()
+        self._records.close()
+
+        # Everything is copied in chunks, so finishing a snapshot takes no more memory than writing it
+        records_path = os.path.join(self.build_directory, "records.jsonl")
+        names = set()
+        id_length = hash_length = 1
+        with open(records_path) as f:
+            for line in f:
+                record = json.loads(line)
+                names.update(record["metadata"])
+                id_length = max(id_length, len(record["id"]))
+                hash_length = max(hash_length, len(record["hash"]))
+
+        ids = np.lib.format.open_memmap(
+            os.path.join(self.build_directory, "ids.npy"), mode="w+", dtype=f"<U{id_length}", shape=(self._rows,)
+        )
+        hashes = np.lib.format.open_memmap(
+            os.path.join(self.build_directory, "hashes.npy"), mode="w+", dtype=f"<U{hash_length}", shape=(self._rows,)
+        )
+        with open(records_path) as f:
+            for row, line in enumerate(f):
+                record = json.loads(line)
+                ids[row] = record["id"]
+                hashes[row] = record["hash"]
+        ids.flush()
+        hashes.flush()
+        del ids, hashes
+
+        # One pass over the records per column, each written as a JSON list
+        with open(os.path.join(self.build_directory, "metadata.json"), "w") as out:
+            out.write("{")
+            for position, name in enumerate(sorted(names)):
+                out.write(("," if position else "") + json.dumps(name) + ":[")
+                with open(records_path) as f:
+                    for row, line in enumerate(f):
+                        out.write(("," if row else "") + json.dumps(json.loads(line)["metadata"].get(name)))
+                out.write("]")
+            out.write("}")
+
+        raw_path = os.path.join(self.build_directory, "embeddings.raw")
+        raw = np.memmap(raw_path, dtype=np.float16, mode="r", shape=(self._rows, self.dim)) if self._rows else np.zeros((0, self.dim), np.float16)
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(self.build_directory, "embeddings.npy"), mode="w+", dtype=np.float16, shape=(self._rows, self.dim)
+        )
+        for start in range(0, self._rows, 10000):
+            embeddings[start:start + 10000] = raw[start:start + 10000]
+        embeddings.flush()
+        del raw, embeddings
+        os.remove(raw_path)
+        os.remove(records_path)
+
+        version = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        while os.path.exists(os.path.join(self.root, version)):
+            time.sleep(1)
+            version = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        manifest = {"version": version, "rows": self._rows, "embedding": self.embedding_manifest}
+        with open(os.path.join(self.build_directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        os.replace(self.build_directory, os.path.join(self.root, version))
+        print(f"Snapshot {version} written with {self._rows} products")
+        return version
+
+
+def prune(keep, protected=(), root=None):
+    """Delete all but the newest keep versions, never one in protected."""
+    root = root or snapshot_root()
+    found = versions(root)
+    for version in found[:max(len(found) - keep, 0)]:
+        if version not in protected:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+            print(f"Deleted snapshot {version}")
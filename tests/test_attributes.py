@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attributes import extract_metadata, parse_price_range, price_band, price_bands_between, query_filter
+from retrieval import matches_filter
+
+
+def test_query_filter_names_category_color_and_gender():
+    assert query_filter("black formal shoes for men") == {"$and": [
+        {"category": {"$in": ["shoes"]}},
+        {"color": {"$in": ["black"]}},
+        {"gender": {"$in": ["men", "unisex"]}},
+    ]}
+    assert query_filter("Grey T-Shirts") == {"$and": [{"category": {"$in": ["tshirt"]}}, {"color": {"$in": ["grey"]}}]}
+    assert query_filter("any suggestions for a party?") is None
+
+
+def test_price_bands_follow_the_bound_in_the_query(monkeypatch):
+    monkeypatch.setenv("PRICE_BANDS", "500,1000,2000")
+    assert price_band(999.99) == "500-1000"
+    assert price_band(1000) == "1000-2000"
+    assert price_band(2500) == "2000+"
+    assert parse_price_range("shoes under Rs. 1,000") == (0, 1000, False)
+    assert price_bands_between(*parse_price_range("shoes under 1000")) == ["0-500", "500-1000"]
+    assert price_bands_between(*parse_price_range("shoes up to 1000")) == ["0-500", "500-1000", "1000-2000"]
+    assert price_bands_between(*parse_price_range("shoes above 1000")) == ["1000-2000", "2000+"]
+    assert parse_price_range("shoes in size 10") is None
+
+
+def test_product_metadata_passes_the_filter_of_a_query_describing_it(monkeypatch):
+    monkeypatch.setenv("PRICE_BANDS", "500,1000,2000")
+    jacket = extract_metadata("Men's blue and black denim jacket", 1200)
+    assert matches_filter(jacket, query_filter("blue jacket for men under 2000"))
+    assert not matches_filter(jacket, query_filter("blue jacket for men under 1000"))
+    assert not matches_filter(jacket, query_filter("blue jacket for women"))
+    # No gender in the description: stored as unisex, which every gender accepts
+    cap = extract_metadata("Red cotton cap")
+    assert cap["gender"] == ["unisex"]
+    assert matches_filter(cap, query_filter("red cap for girls"))
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_cache import EmbeddingCache
+
+
+def vector(seed):
+    return np.random.default_rng(seed).random(4).astype(np.float32)
+
+
+def test_reopened_cache_replays_the_log(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    cache = EmbeddingCache("model", max_entries=4, path=path)
+    for n in range(3):
+        cache.put(f"query {n}", vector(n))
+    # Storing a key again rewrites its slot; the log must not bring the old vector back
+    cache.put("query 0", vector(10))
+
+    reopened = EmbeddingCache("model", max_entries=4, path=path)
+    assert np.allclose(reopened.get("Query 0 "), vector(10))
+    assert np.allclose(reopened.get("query 2"), vector(2))
+    assert reopened.stats()["entries"] == 3
+
+
+def test_evicted_key_is_not_served_with_its_slots_new_vector(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    cache = EmbeddingCache("model", max_entries=2, path=path)
+    for n in range(5):
+        cache.put(f"query {n}", vector(n))
+    live = {key: slot for key, (slot, _) in cache._entries.items()}
+
+    reopened = EmbeddingCache("model", max_entries=2, path=path)
+    assert {key: slot for key, (slot, _) in reopened._entries.items()} == live
+    assert reopened.get("query 0") is None
+    assert np.allclose(reopened.get("query 4"), vector(4))
+
+
+def test_truncated_log_line_is_skipped(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    cache = EmbeddingCache("model", max_entries=8, path=path)
+    cache.put("query 0", vector(0))
+    cache.put("query 1", vector(1))
+    with open(path + ".log", "a") as f:
+        f.write("deadbeef 3")
+
+    reopened = EmbeddingCache("model", max_entries=8, path=path)
+    assert np.allclose(reopened.get("query 1"), vector(1))
+    assert reopened.stats()["entries"] == 2
+
+
+def test_cache_for_another_model_starts_empty(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    EmbeddingCache("model", max_entries=4, path=path).put("query", vector(0))
+    assert EmbeddingCache("other-model", max_entries=4, path=path).get("query") is None
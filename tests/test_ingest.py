@@ -0,0 +1,111 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("psycopg2")
+
+import pinecone_setup
+import resources
+import snapshot
+from retrieval import read_pinecone_manifest
+
+
+class FakeModel:
+    def encode(self, texts, batch_size=None):
+        return np.array([[len(text), 1.0, 0.5, 0.25] for text in texts], dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return 4
+
+
+class FakeIndex:
+    def __init__(self):
+        self.namespaces = {}
+
+    def upsert(self, vectors, namespace=""):
+        self.namespaces.setdefault(namespace, {}).update({vector["id"]: vector for vector in vectors})
+
+    def delete(self, ids=None, namespace="", delete_all=False):
+        if delete_all:
+            self.namespaces.pop(namespace, None)
+        for id in ids or []:
+            self.namespaces[namespace].pop(id, None)
+
+    def fetch(self, ids, namespace=""):
+        vectors = self.namespaces.get(namespace, {})
+        return {"vectors": {id: vectors[id] for id in ids if id in vectors}}
+
+    def describe_index_stats(self):
+        return {"namespaces": {name: {"vector_count": len(vectors)} for name, vectors in self.namespaces.items()}}
+
+
+class FakeCursor:
+    def __init__(self, rows, fail_after):
+        self.rows = rows
+        self.fail_after = fail_after
+
+    def execute(self, query, args):
+        self.rows = [row for row in self.rows if row[0] > args[0]]
+
+    def fetchmany(self, size):
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise RuntimeError("connection lost")
+            self.fail_after -= 1
+        chunk, self.rows = self.rows[:size], self.rows[size:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+
+    def cursor(self, name=None):
+        return FakeCursor(self.rows, self.fail_after)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def ingest_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("PINECONE_API_KEY", "test")
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.delenv("LOCAL_INDEX_DIR", raising=False)
+    monkeypatch.setattr(pinecone_setup, "STATE_PATH", str(tmp_path / "state.sqlite"))
+    monkeypatch.setattr(pinecone_setup, "KEYWORD_INDEX_PATH", None)
+    monkeypatch.setattr(pinecone_setup, "FETCH_SIZE", 2)
+    monkeypatch.setattr(pinecone_setup, "bump_catalog_version", lambda: None)
+    index = FakeIndex()
+    monkeypatch.setitem(resources._resources, "model", FakeModel())
+    monkeypatch.setitem(resources._resources, "pinecone_index", index)
+    return index
+
+
+def test_resumed_run_publishes_changes_embedded_before_the_crash(ingest_env, monkeypatch):
+    rows = [(id, f"red cotton shirt {id}", f"http://example.com/{id}.jpg") for id in range(1, 7)]
+    monkeypatch.setattr(pinecone_setup, "connect_db", lambda database: FakeConnection(rows))
+    pinecone_setup.ingest()
+    first_version = read_pinecone_manifest(ingest_env)["version"]
+
+    # The only changed row is in the first chunk, which is checkpointed before the crash
+    rows[0] = (1, "blue denim jacket", "http://example.com/1.jpg")
+    monkeypatch.setattr(pinecone_setup, "connect_db", lambda database: FakeConnection(rows, fail_after=1))
+    with pytest.raises(RuntimeError):
+        pinecone_setup.ingest()
+
+    monkeypatch.setattr(pinecone_setup, "connect_db", lambda database: FakeConnection(rows))
+    pinecone_setup.ingest()
+
+    alias = read_pinecone_manifest(ingest_env)
+    assert alias["version"] != first_version
+    assert snapshot.load().metadata(0)["description"] == "blue denim jacket"
+    assert ingest_env.namespaces[alias["namespace"]]["1"]["metadata"]["description"] == "blue denim jacket"
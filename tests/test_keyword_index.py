@@ -0,0 +1,79 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import resources
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+
+def add_products(index, descriptions):
+    index.add(
+        list(descriptions),
+        list(descriptions.values()),
+        [{"description": description, "gender": "men" if "men" in description.split() else "women"}
+         for description in descriptions.values()]
+    )
+
+
+def test_search_ranks_by_bm25_and_applies_the_filter(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keywords.sqlite"))
+    add_products(index, {
+        "1": "black formal shoes men",
+        "2": "black running shoes women",
+        "3": "blue denim jacket men",
+        "4": "black formal shoes women",
+    })
+    assert [match["id"] for match in index.search("black formal shoes", 2)] == ["1", "4"]
+    assert [match["id"] for match in index.search("black formal shoes", 4, filter={"gender": "women"})] == ["4", "2"]
+    assert index.search("red saree", 4) == []
+
+
+def test_search_sees_changes_made_by_another_connection(tmp_path):
+    path = str(tmp_path / "keywords.sqlite")
+    writer = KeywordIndex(path)
+    add_products(writer, {"1": "black formal shoes men"})
+    reader = KeywordIndex(path, refresh_seconds=0)
+    assert [match["id"] for match in reader.search("shoes", 5)] == ["1"]
+
+    add_products(writer, {"2": "brown leather shoes men"})
+    writer.delete(["1"])
+    assert [match["id"] for match in reader.search("shoes", 5)] == ["2"]
+
+
+def match(id, score=0.0):
+    return {"id": id, "score": score, "metadata": {"description": f"product {id}", "uri": id}}
+
+
+def test_fusion_ranks_products_found_by_both_searches_first():
+    dense = [match("a", 0.9), match("b", 0.8), match("c", 0.7)]
+    keyword = [match("c", 12.0), match("d", 9.0), match("a", 3.0)]
+    fused = reciprocal_rank_fusion([dense, keyword], top_k=3, k=60)
+    assert [item["id"] for item in fused] == ["a", "c", "b"]
+    assert fused[0]["score"] == 1 / 61 + 1 / 63
+    assert reciprocal_rank_fusion([[], []], top_k=3) == []
+
+
+def test_fusion_keeps_the_first_metadata_seen():
+    dense = [dict(match("a"), metadata={"description": "dense copy", "uri": "a"})]
+    keyword = [dict(match("a"), metadata={"description": "keyword copy", "uri": "a"})]
+    assert reciprocal_rank_fusion([dense, keyword], top_k=1)[0]["metadata"]["description"] == "dense copy"
+
+
+class FakeBackend:
+    def query(self, vector, top_k, filter=None):
+        return [match("a", 0.83), match("b", 0.61)]
+
+
+class FakeKeywordIndex:
+    def search(self, text, top_k, filter=None):
+        return [match("z", 14.2), match("b", 7.5)]
+
+
+def test_fused_products_keep_their_dense_similarity(monkeypatch):
+    monkeypatch.setitem(resources._resources, "retrieval_backend", FakeBackend())
+    monkeypatch.setitem(resources._resources, "keyword_index", FakeKeywordIndex())
+    products = main.retrieve_products([1.0, 0.0], query_text="product b")
+    assert [product["uri"] for product in products] == ["b", "a", "z"]
+    assert [product["similarity"] for product in products] == [0.61, 0.83, 0.0]
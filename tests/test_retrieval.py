@@ -0,0 +1,84 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import LocalBackend, LocalIndexWriter, matches_filter
+
+MANIFEST = {"model": "test-model", "mode": "float32", "truncate_dim": None, "dim": 2}
+
+
+def write_index(directory, descriptions, version):
+    writer = LocalIndexWriter(directory, keep_existing=False, manifest=MANIFEST)
+    writer.add(
+        [str(id) for id in range(len(descriptions))],
+        np.eye(2)[:len(descriptions)],
+        [{"description": description} for description in descriptions]
+    )
+    writer.close(version=version)
+
+
+def test_local_backend_reopens_a_new_snapshot_version(tmp_path):
+    directory = str(tmp_path / "local_index")
+    write_index(directory, ["red shirt", "blue jeans"], "v1")
+    backend = LocalBackend(directory, refresh_seconds=1e-6)
+    assert backend.version == "v1"
+    assert backend.query([1.0, 0.0], 1)[0]["metadata"]["description"] == "red shirt"
+
+    write_index(directory, ["green hat", "blue jeans"], "v2")
+    assert backend.query([1.0, 0.0], 1)[0]["metadata"]["description"] == "green hat"
+    assert backend.version == "v2"
+
+
+def test_local_backend_keeps_searching_when_the_index_is_missing(tmp_path):
+    directory = str(tmp_path / "local_index")
+    write_index(directory, ["red shirt"], "v1")
+    backend = LocalBackend(directory, refresh_seconds=1e-6)
+    os.remove(os.path.join(directory, "manifest.json"))
+    assert backend.query([1.0, 0.0], 1)[0]["metadata"]["description"] == "red shirt"
+    assert backend.version == "v1"
+
+
+def test_resumed_local_writer_keeps_rows_up_to_the_checkpoint(tmp_path):
+    directory = str(tmp_path / "local_index")
+    write_index(directory, ["red shirt", "blue jeans"], "v1")
+
+    writer = LocalIndexWriter(directory, manifest=MANIFEST)
+    writer.add(["1"], [[0.0, 2.0]], [{"description": "blue jeans, new fit"}])
+    writer.flush()
+    checkpoint = (writer.rows, writer.dim)
+    writer.add(["2"], [[1.0, 1.0]], [{"description": "written after the checkpoint"}])
+    writer.flush()
+
+    writer = LocalIndexWriter(directory, resume=checkpoint, manifest=MANIFEST)
+    writer.add(["3"], [[-1.0, 0.0]], [{"description": "green hat"}])
+    writer.close(deleted_ids=["0"], version="v2")
+
+    backend = LocalBackend(directory)
+    assert sorted(backend.ids) == ["1", "3"]
+    assert backend.version == "v2"
+    assert backend.query([0.0, 1.0], 1)[0]["metadata"]["description"] == "blue jeans, new fit"
+    assert np.allclose(np.linalg.norm(backend.vectors, axis=1), 1.0)
+
+
+def test_matches_filter_operators_on_list_and_missing_values():
+    metadata = {"color": ["black", "blue"], "gender": ["men"], "price_band": "500-1000"}
+    assert matches_filter(metadata, {"color": "blue"})
+    assert matches_filter(metadata, {"color": {"$in": ["red", "black"]}})
+    assert not matches_filter(metadata, {"color": {"$nin": ["blue"]}})
+    assert not matches_filter(metadata, {"color": {"$ne": "black"}})
+    assert matches_filter(metadata, {"$or": [{"gender": "women"}, {"price_band": "500-1000"}]})
+    assert not matches_filter(metadata, {"$and": [{"gender": "men"}, {"category": {"$in": ["shoes"]}}]})
+    # A product without the field matches only negative conditions
+    assert matches_filter(metadata, {"category": {"$nin": ["shoes"]}})
+    assert not matches_filter(metadata, {"category": {"$in": ["shoes"]}})
+
+
+def test_local_backend_searches_only_rows_passing_the_filter(tmp_path):
+    directory = str(tmp_path / "local_index")
+    write_index(directory, ["red shirt", "blue jeans"], "v1")
+    backend = LocalBackend(directory)
+    matches = backend.query([1.0, 0.0], 2, filter={"description": {"$in": ["blue jeans"]}})
+    assert [match["id"] for match in matches] == ["1"]
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler
+
+
+def test_cancelled_acall_gives_back_its_slot(monkeypatch):
+    monkeypatch.setenv("SCHEDULER_LEAKCHECK_CONCURRENCY", "1")
+
+    async def slow():
+        await asyncio.sleep(0.2)
+        return "slow"
+
+    async def fast():
+        return "fast"
+
+    async def run():
+        holder = asyncio.ensure_future(scheduler.acall("leakcheck", "leakcheck", slow, timeout=2))
+        await asyncio.sleep(0.05)
+        # Waits for the only slot, and is cancelled before it frees up
+        waiter = asyncio.ensure_future(scheduler.acall("leakcheck", "leakcheck", fast, timeout=2))
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        assert await holder == "slow"
+        # The waiting thread takes the slot once the holder is done, and must hand it back
+        await asyncio.sleep(0.1)
+        return await scheduler.acall("leakcheck", "leakcheck", fast, timeout=0.5)
+
+    assert asyncio.run(run()) == "fast"
+    service = scheduler._service("leakcheck")
+    assert service.slots.acquire(blocking=False)
+    service.release()
+
+
+def test_call_passes_the_time_left_as_the_request_timeout():
+    seen = {}
+
+    def request(**kwargs):
+        seen.update(kwargs)
+        return "done"
+
+    assert scheduler.call("timeoutcheck", "timeoutcheck", request, timeout=2, timeout_argument="timeout", q=1) == "done"
+    assert seen["q"] == 1
+    assert 0 < seen["timeout"] <= 2
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+
+MANIFEST = {"model": "test-model", "mode": "float32", "truncate_dim": None, "dim": 2}
+
+
+def test_resumed_writer_drops_rows_after_the_checkpoint(tmp_path):
+    root = str(tmp_path)
+    writer = snapshot.SnapshotWriter(MANIFEST, root=root)
+    writer.add(["1", "2"], [[1, 0], [0, 1]], [{"color": ["red"]}, {"price_band": "0-500"}], ["h1", "h2"])
+    writer.flush()
+    checkpoint = writer.rows
+    # Written after the checkpoint, then the run dies
+    writer.add(["3"], [[1, 1]], [{}], ["stale"])
+    writer.flush()
+
+    writer = snapshot.SnapshotWriter(MANIFEST, root=root, resume=checkpoint)
+    assert writer.rows == 2
+    writer.add(["3", "10"], [[0.5, 0.5], [0, -1]], [{"color": ["blue"]}, {}], ["h3", "h10"])
+    catalog = snapshot.load(writer.close(), root=root)
+
+    assert catalog.ids.tolist() == ["1", "2", "3", "10"]
+    assert catalog.hash_of("3") == "h3"
+    assert np.allclose(catalog.vector(catalog.row_of("10")), [0, -1])
+    assert catalog.metadata(0) == {"color": ["red"]}
+    assert catalog.metadata(1) == {"price_band": "0-500"}
+    assert catalog.metadata(3) == {}
+    assert not os.path.exists(os.path.join(root, ".building"))
+
+
+def test_empty_snapshot(tmp_path):
+    writer = snapshot.SnapshotWriter(MANIFEST, root=str(tmp_path))
+    catalog = snapshot.load(writer.close(), root=str(tmp_path))
+    assert len(catalog) == 0
+    assert catalog.embeddings.shape == (0, 2)
+    assert catalog.row_of("1") is None
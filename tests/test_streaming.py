@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import partial_json_array_items, partial_json_string
+
+
+def test_partial_string_decodes_escapes_and_surrogate_pairs():
+    buffer = json.dumps({"fallback_response": 'Try "chinos" 👖\nor a tee é'})
+    assert partial_json_string(buffer, "fallback_response") == 'Try "chinos" 👖\nor a tee é'
+
+
+def test_every_prefix_decodes_to_a_prefix_of_the_text():
+    text = 'Socks 🧦 and "shoes" 👟\\ done'
+    buffer = json.dumps({"fallback_response": text})
+    previous = ""
+    for end in range(len(buffer) + 1):
+        decoded = partial_json_string(buffer[:end], "fallback_response")
+        if decoded is None:
+            continue
+        assert text.startswith(decoded)
+        assert decoded.startswith(previous)
+        previous = decoded
+    assert previous == text
+
+
+def test_lone_surrogate_halves_become_replacement_characters():
+    assert partial_json_string('{"fallback_response": "a\\ud83d b', "fallback_response") == "a� b"
+    assert partial_json_string('{"fallback_response": "a\\udc56"}', "fallback_response") == "a�"
+    # Whether a low half follows isn't known yet
+    assert partial_json_string('{"fallback_response": "a\\ud83d\\u', "fallback_response") == "a"
+
+
+def test_partial_array_returns_only_complete_items():
+    buffer = '{"results": [{"product_number": 1}, {"product_number": 2}, {"product_n'
+    assert partial_json_array_items(buffer, "results") == [{"product_number": 1}, {"product_number": 2}]
+    assert partial_json_array_items('{"query": "x"', "results") == []
@@ -0,0 +1,91 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Product images are full-size catalog photos; the chat and wishlist grids only
+# need small previews. Thumbnails are downloaded once, resized and kept on disk,
+# so a rerun serves local files instead of re-fetching every image.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _cache_dir():
+    return os.getenv("THUMBNAIL_CACHE_DIR", "thumbnail_cache")
+
+
+def _size():
+    return int(os.getenv("THUMBNAIL_SIZE", "256"))
+
+
+def _path(url, size):
+    digest = hashlib.sha1(f"{size}\x00{url}".encode("utf-8")).hexdigest()
+    return os.path.join(_cache_dir(), digest[:2], digest + ".jpg")
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("THUMBNAIL_WORKERS", "8")), thread_name_prefix="thumbnail"
+            )
+    return _executor
+
+
+def _create(url, size, path):
+    import requests
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    with metrics.span("thumbnail.fetch"):
+        response = requests.get(url, timeout=float(os.getenv("THUMBNAIL_TIMEOUT", "5")))
+        response.raise_for_status()
+        image = Image.open(io.BytesIO(response.content))
+        image.thumbnail((size, size))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name so a concurrent reader never sees half a file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.convert("RGB").save(tmp_path, "JPEG", quality=85)
+        os.replace(tmp_path, path)
+    return path
+
+
+def thumbnail(url, size=None):
+    """Local path of a thumbnail for url, or url itself if it can't be made."""
+    size = size or _size()
+    if size <= 0:
+        return url
+    path = _path(url, size)
+    if os.path.exists(path):
+        return path
+    # A recent failure is remembered, so a broken image doesn't stall every rerun;
+    # the browser loads the original instead
+    failed_path = path + ".failed"
+    try:
+        if time.time() - os.path.getmtime(failed_path) < float(os.getenv("THUMBNAIL_FAILURE_TTL", "3600")):
+            return url
+    except OSError:
+        pass
+    try:
+        return _create(url, size, path) or url
+    except Exception as e:
+        print(f"Couldn't create a thumbnail for {url}: {e}")
+        try:
+            os.makedirs(os.path.dirname(failed_path), exist_ok=True)
+            with open(failed_path, "w"):
+                pass
+        except OSError:
+            pass
+        return url
+
+
+def thumbnails(urls, size=None):
+    """Thumbnails for all urls, fetching the missing ones in parallel."""
+    return list(_get_executor().map(lambda url: thumbnail(url, size), urls))
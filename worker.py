@@ -0,0 +1,186 @@
+"""Suggestion pipeline as a local service, so app.py doesn't run it in the Streamlit script thread.
+
+    python worker.py                          # listens on WORKER_ADDRESS
+
+WORKER_ADDRESS is host:port or unix:/path/to/socket. The OpenAI calls run on
+the service's event loop; embedding, retrieval and local reranking run in a
+pool of WORKER_PROCESSES processes that each load the model and index once.
+Concurrent query embeddings are micro-batched before they go to the pool.
+app.py uses it when WORKER_URL is set to the same address.
+
+POST /suggestions takes {"user_query", "context", "history"} and streams one
+JSON event per line: ["result", item], ["text", delta], ["done", json],
+["error", message] and finally ["history", history], the session's updated
+reranking history.
+"""
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import resources
+
+
+def _parse_address(address):
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+# ------------------------------------------------------------------------------------------
+# Client, used by app.py
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def _connect(address, timeout):
+    kind, target = _parse_address(address)
+    if kind == "unix":
+        return _UnixHTTPConnection(target, timeout)
+    return http.client.HTTPConnection(*target, timeout=timeout)
+
+
+def stream_suggestions(user_query, context, conversation_history, address=None):
+    """Same events as main.stream_suggestions_sync, computed by the worker service.
+
+    conversation_history is updated in place with the service's copy.
+    """
+    address = address or os.getenv("WORKER_URL")
+    connection = _connect(address, float(os.getenv("WORKER_TIMEOUT", "120")))
+    try:
+        body = json.dumps({"user_query": user_query, "context": context, "history": conversation_history})
+        connection.request("POST", "/suggestions", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        if response.status != 200:
+            yield ("error", RuntimeError(f"Worker service answered {response.status}: {response.read()[:200]!r}"))
+            return
+        for line in response:
+            event, payload = json.loads(line)
+            if event == "history":
+                conversation_history[:] = payload
+            elif event == "error":
+                yield ("error", RuntimeError(payload))
+            else:
+                yield (event, payload)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        # Unreachable, died mid-response (IncompleteRead) or sent a line that isn't JSON
+        print(f"Worker service at {address} is unavailable: {e}")
+        yield ("error", e)
+    finally:
+        connection.close()
+
+
+# ------------------------------------------------------------------------------------------
+# Service
+
+def _init_process():
+    # Runs once in each pool process: load everything the CPU-bound steps need
+    resources.configure()
+    resources.get_model()
+    resources.get_retrieval_backend()
+    resources.get_keyword_index()
+
+
+def _ready():
+    return os.getpid()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send_line(self, event, payload):
+        data = (json.dumps([event, payload]) + "\n").encode("utf-8")
+        # Chunked, so the app can show each event as it comes
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        body = json.dumps({"status": "ok", "processes": self.server.processes}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/suggestions":
+            self.send_error(404)
+            return
+        from main import stream_suggestions_sync
+
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        history = request.get("history") or []
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        with metrics.span("worker.request"):
+            for event, payload in stream_suggestions_sync(request["user_query"], request.get("context") or [], history):
+                self._send_line(event, str(payload) if event == "error" else payload)
+        self._send_line("history", history)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+def serve(address=None, processes=None):
+    address = address or os.getenv("WORKER_ADDRESS", "127.0.0.1:8765")
+    processes = processes or int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+
+    # Spawned, not forked: this process runs threads (event loop, metrics server)
+    executor = ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn"), initializer=_init_process
+    )
+    # Start the processes now rather than on the first request
+    for future in [executor.submit(_ready) for _ in range(processes)]:
+        future.result()
+    print(f"Worker pool with {processes} processes ready")
+    resources.override("cpu_executor", executor)
+    metrics.start_http_server()
+
+    kind, target = _parse_address(address)
+    if kind == "unix":
+        if os.path.exists(target):
+            os.remove(target)
+        server = _ThreadingUnixHTTPServer(target, _Handler)
+    else:
+        server = ThreadingHTTPServer(target, _Handler)
+    server.processes = processes
+    print(f"Serving suggestions on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    serve()